@@ -0,0 +1,220 @@
+"""Columnar snapshot of expense data for cross-user analytics.
+
+The snapshot lives in ANALYTICS_DIR as Parquet files, split into
+ANALYTICS_SHARDS shards by a hash of the user id:
+
+* months-NNN.parquet: one row per (user, year, month) with budget and spend
+* items-NNN.parquet: one row per expense line item
+
+Refreshing a set of changed users only rewrites the shards they hash to, so
+the live `expenses` collection is never scanned by an analytics request.
+Aggregations run vectorized over pandas/NumPy frames loaded once per
+snapshot generation. Every write of the snapshot touches its GENERATION file,
+so workers that share ANALYTICS_DIR reload after a refresh made by another.
+"""
+import glob
+import os
+import shutil
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_DIR = os.getenv("ANALYTICS_DIR", "analytics_snapshot")
+SHARDS = int(os.getenv("ANALYTICS_SHARDS", "16"))
+
+MONTH_COLUMNS = ["user_id", "year", "month", "month_number", "monthly_budget", "amount_spent"]
+ITEM_COLUMNS = ["user_id", "year", "month", "month_number", "category", "sub_category", "amount_spent"]
+PERCENTILES = [10, 25, 50, 75, 90]
+
+
+def shard_of(user_id):
+    return zlib.crc32(user_id.encode()) % SHARDS
+
+
+def shard_path(kind, shard):
+    return os.path.join(SNAPSHOT_DIR, f"{kind}-{shard:03d}.parquet")
+
+
+def generation_path():
+    return os.path.join(SNAPSHOT_DIR, "GENERATION")
+
+
+def build_dir():
+    return os.path.join(SNAPSHOT_DIR, "build")
+
+
+def snapshot_exists():
+    return os.path.exists(shard_path("months", 0))
+
+
+class ShardRows:
+    def __init__(self):
+        self.users = set()
+        self.months = []
+        self.items = []
+
+
+# Flatten {"user_id", "year", "months": [...]} documents into rows per shard
+def collect_rows(documents, month_numbers):
+    shards = {}
+    for doc in documents:
+        rows = shards.setdefault(shard_of(doc["user_id"]), ShardRows())
+        rows.users.add(doc["user_id"])
+        for m in doc["months"]:
+            number = month_numbers[m["month"]]
+            rows.months.append((doc["user_id"], doc["year"], m["month"], number, m["monthly_budget"], m["amount_spent"]))
+            for c in m["categories"]:
+                for sc in c["sub_categories"]:
+                    rows.items.append((doc["user_id"], doc["year"], m["month"], number, c["category"],
+                                       sc["sub_category"], sc["amount_spent"]))
+    return shards
+
+
+def _write(path, frame):
+    # Unique per writer, so two writers never share a half-written file
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    frame.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+# Replace the rows of the given shards' users. With full=True every shard is
+# rewritten from `shards` alone, including shards that ended up empty.
+def write_shards(shards, full=False):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    targets = range(SHARDS) if full else shards.keys()
+    for shard in targets:
+        rows = shards.get(shard, ShardRows())
+        for kind, columns, new_rows in (("months", MONTH_COLUMNS, rows.months), ("items", ITEM_COLUMNS, rows.items)):
+            path = shard_path(kind, shard)
+            frame = pd.DataFrame(new_rows, columns=columns)
+            if not full and os.path.exists(path):
+                old = pd.read_parquet(path)
+                frame = pd.concat([old[~old["user_id"].isin(rows.users)], frame], ignore_index=True)
+            _write(path, frame)
+    _published()
+
+
+def _published():
+    with open(generation_path(), "w") as f:
+        f.write(str(time.time_ns()))
+    snapshot.invalidate()
+
+
+# A full rebuild written batch by batch: add() stores each batch's rows as
+# part files under build/, and finish() assembles one shard at a time, so
+# memory is bounded by a batch and then by a shard. months-000, which
+# snapshot_exists() looks for, is moved into place last.
+class FullBuild:
+    def __init__(self):
+        shutil.rmtree(build_dir(), ignore_errors=True)
+        os.makedirs(build_dir())
+        self.parts = 0
+
+    def add(self, shards):
+        for shard, rows in shards.items():
+            for kind, columns, new_rows in (("months", MONTH_COLUMNS, rows.months), ("items", ITEM_COLUMNS, rows.items)):
+                if new_rows:
+                    part = os.path.join(build_dir(), f"{kind}-{shard:03d}-{self.parts:06d}.parquet")
+                    pd.DataFrame(new_rows, columns=columns).to_parquet(part, index=False)
+        self.parts += 1
+
+    def finish(self):
+        for shard in reversed(range(SHARDS)):
+            for kind, columns in (("items", ITEM_COLUMNS), ("months", MONTH_COLUMNS)):
+                parts = sorted(glob.glob(os.path.join(build_dir(), f"{kind}-{shard:03d}-*.parquet")))
+                frame = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True) if parts else pd.DataFrame(columns=columns)
+                _write(shard_path(kind, shard), frame)
+        shutil.rmtree(build_dir())
+        _published()
+
+
+class Snapshot:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frames = None
+        self._generation = None
+
+    def invalidate(self):
+        with self._lock:
+            self._frames = None
+
+    def frames(self):
+        try:
+            generation = os.stat(generation_path()).st_mtime_ns
+        except FileNotFoundError:
+            generation = None
+        with self._lock:
+            if self._frames is None or generation != self._generation:
+                self._generation = generation
+                months = [pd.read_parquet(shard_path("months", s)) for s in range(SHARDS) if os.path.exists(shard_path("months", s))]
+                items = [pd.read_parquet(shard_path("items", s)) for s in range(SHARDS) if os.path.exists(shard_path("items", s))]
+                self._frames = (
+                    pd.concat(months, ignore_index=True) if months else pd.DataFrame(columns=MONTH_COLUMNS),
+                    pd.concat(items, ignore_index=True) if items else pd.DataFrame(columns=ITEM_COLUMNS),
+                )
+            return self._frames
+
+
+snapshot = Snapshot()
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return {f"p{p}": None for p in PERCENTILES}
+    return {f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+
+
+# Distribution of per-user spend in each category for one month
+def category_spend(year, month):
+    _, items = snapshot.frames()
+    selected = items[(items["year"] == year) & (items["month"] == month)]
+    per_user = selected.groupby(["category", "user_id"], sort=False)["amount_spent"].sum()
+    result = []
+    for category, spend in per_user.groupby(level="category"):
+        values = spend.to_numpy()
+        result.append({
+            "category": category,
+            "users": int(values.size),
+            "total": int(values.sum()),
+            "mean": float(values.mean()),
+            **_percentiles(values),
+        })
+    return sorted(result, key=lambda r: r["total"], reverse=True)
+
+
+# Percentiles of monthly_budget - amount_spent across users for one month
+def savings_percentiles(year, month):
+    months, _ = snapshot.frames()
+    selected = months[(months["year"] == year) & (months["month"] == month)]
+    savings = (selected["monthly_budget"] - selected["amount_spent"]).to_numpy()
+    return {
+        "month": month,
+        "year": year,
+        "users": int(savings.size),
+        "mean": float(savings.mean()) if savings.size else None,
+        **_percentiles(savings),
+    }
+
+
+# Total and average spend per month of a year, with the change on the month before
+def month_over_month(year):
+    months, _ = snapshot.frames()
+    selected = months[months["year"] == year]
+    per_month = selected.groupby(["month_number", "month"])["amount_spent"].agg(["sum", "mean", "count"]).sort_index()
+    totals = per_month["sum"].to_numpy(dtype=float)
+    previous = np.concatenate(([np.nan], totals[:-1]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = np.where(previous > 0, (totals - previous) / previous, np.nan)
+    return [
+        {
+            "month": month,
+            "users": int(row["count"]),
+            "total_spent": int(row["sum"]),
+            "mean_spent": float(row["mean"]),
+            "change_from_previous": None if np.isnan(delta) else float(delta),
+        }
+        for ((_, month), row), delta in zip(per_month.iterrows(), change)
+    ]
@@ -0,0 +1,97 @@
+"""Shared HTTP client for the Streamlit frontend.
+
+One requests.Session per Streamlit server (via st.cache_resource), so backend
+calls reuse keep-alive connections instead of opening one per request. Every
+call gets a timeout, idempotent calls are retried with backoff, and each call's
+latency is logged under the "api_client" logger, to stderr at the level in
+EXPENSE_API_LOG_LEVEL (default INFO; WARNING hides the per-call lines). PATCH
+calls carry an Idempotency-Key, so they are retried like the idempotent methods.
+
+The session token from /login is kept in st.session_state (the Session is
+shared by every browser tab) and sent as a bearer token on each call; a 401
+for a call that carried one means it expired, so the login is forgotten.
+"""
+import logging
+import os
+import time
+import uuid
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+BASE_URL = os.getenv("EXPENSE_API_URL", "http://127.0.0.1:8000")
+CONNECT_TIMEOUT = float(os.getenv("EXPENSE_API_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.getenv("EXPENSE_API_READ_TIMEOUT", "10"))
+POOL_SIZE = int(os.getenv("EXPENSE_API_POOL_SIZE", "20"))
+LOG_LEVEL = os.getenv("EXPENSE_API_LOG_LEVEL", "INFO").upper()
+
+# Streamlit doesn't configure the root logger, so without a handler of its
+# own the latency lines would go nowhere
+logger = logging.getLogger("api_client")
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+
+
+@st.cache_resource
+def get_session():
+    # POST is left out: re-sending an expense or registration could duplicate it.
+    # Connection failures are still retried, since nothing reached the server.
+    # A retried PATCH resends its Idempotency-Key, so the API applies it once.
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "PUT", "PATCH", "DELETE", "OPTIONS"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def request(method, path, **kwargs):
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    token = st.session_state.get("session_token")
+    if token:
+        kwargs["headers"] = {"Authorization": f"Bearer {token}", **kwargs.get("headers", {})}
+    start = time.perf_counter()
+    status = "error"
+    try:
+        response = get_session().request(method, f"{BASE_URL}{path}", **kwargs)
+        status = response.status_code
+        if status == 401 and token:
+            st.session_state.pop("session_token", None)
+            st.session_state.pop("user_id", None)
+        return response
+    finally:
+        logger.info("%s %s -> %s in %.1f ms", method, path, status, (time.perf_counter() - start) * 1000)
+
+
+def get(path, **kwargs):
+    return request("GET", path, **kwargs)
+
+
+def post(path, **kwargs):
+    return request("POST", path, **kwargs)
+
+
+def put(path, **kwargs):
+    return request("PUT", path, **kwargs)
+
+
+def delete(path, **kwargs):
+    return request("DELETE", path, **kwargs)
+
+
+def patch(path, **kwargs):
+    kwargs["headers"] = {"Idempotency-Key": str(uuid.uuid4()), **kwargs.get("headers", {})}
+    return request("PATCH", path, **kwargs)
@@ -0,0 +1,125 @@
+"""Password hashing and session tokens.
+
+Passwords are stored as scrypt hashes ("scrypt$N$r$p$salt$hash"). scrypt is
+deliberately slow, so hashing and verification run in a bounded thread pool
+(hashlib.scrypt releases the GIL) instead of on the event loop. Rows that
+still hold a plaintext password verify against it once and are rehashed.
+
+A successful login returns an HMAC-signed session token. Later requests send
+it as "Authorization: Bearer <token>" and are checked with one HMAC instead of
+another scrypt run. Set SESSION_SECRET to the same value on every worker, or
+tokens only verify on the worker that issued them.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+
+logger = logging.getLogger("auth")
+
+SCRYPT_N = int(os.getenv("SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.getenv("SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("SCRYPT_P", "1"))
+# Concurrent hash computations; each one holds 128 * N * r bytes (16 MiB by default)
+HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", str(os.cpu_count() or 1)))
+
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "900"))
+SESSION_SECRET = os.getenv("SESSION_SECRET", "").encode()
+if not SESSION_SECRET:
+    logger.warning("SESSION_SECRET is not set; session tokens won't survive a restart or work across workers")
+    SESSION_SECRET = secrets.token_bytes(32)
+
+_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="scrypt")
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    salt = secrets.token_bytes(16)
+    return f"scrypt${n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, n, r, p))}"
+
+
+def is_hashed(stored):
+    return stored.startswith("scrypt$")
+
+
+# True for plaintext rows and hashes made with other cost parameters
+def needs_rehash(stored):
+    return not is_hashed(stored) or stored.split("$")[1:4] != [str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+
+
+def verify_password(password, stored):
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, n, r, p, salt, expected = stored.split("$")
+    return hmac.compare_digest(_scrypt(password, _unb64(salt), int(n), int(r), int(p)), _unb64(expected))
+
+
+async def hash_password_async(password):
+    return await asyncio.get_running_loop().run_in_executor(_pool, hash_password, password)
+
+
+async def verify_password_async(password, stored):
+    return await asyncio.get_running_loop().run_in_executor(_pool, verify_password, password, stored)
+
+
+# Recently verified (user, password) pairs, keyed by an HMAC of the password
+# so the cache never holds it in the clear. An entry only counts while the
+# stored hash is unchanged.
+credential_cache = LRUCache(
+    max_entries=int(os.getenv("CREDENTIAL_CACHE_ENTRIES", "10000")),
+    ttl=int(os.getenv("CREDENTIAL_CACHE_TTL_SECONDS", "300")),
+)
+
+
+def _password_digest(user_id, password):
+    return hmac.new(SESSION_SECRET, f"{user_id}\0{password}".encode(), hashlib.sha256).hexdigest()
+
+
+async def check_credentials(user_id, password, stored):
+    digest = _password_digest(user_id, password)
+    if await credential_cache.get(user_id) == [digest, stored]:
+        return True
+    if not await verify_password_async(password, stored):
+        return False
+    await credential_cache.set(user_id, [digest, stored])
+    return True
+
+
+def issue_token(user_id, ttl=SESSION_TTL_SECONDS):
+    payload = _b64(json.dumps({"sub": user_id, "exp": int(time.time()) + ttl}).encode())
+    signature = _b64(hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest())
+    return f"{payload}.{signature}"
+
+
+# The user id a token was issued to, or None if it is forged, malformed or expired
+def verify_token(token):
+    payload, _, signature = token.partition(".")
+    expected = _b64(hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest())
+    if not hmac.compare_digest(signature, expected):
+        return None
+    try:
+        claims = json.loads(_unb64(payload))
+    except ValueError:
+        return None
+    if claims.get("exp", 0) < time.time():
+        return None
+    return claims.get("sub")
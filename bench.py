@@ -0,0 +1,215 @@
+"""Reproducible benchmark for every API route.
+
+Seeds a synthetic population into a dedicated database, then drives each
+route in-process through httpx's ASGI transport. There is no HTTP server and
+no network hop, only the app and a local mongod:
+
+    MONGO_URI=mongodb://localhost:27017 python bench.py --users 10000 --reset \\
+        --output bench-results.json
+    python bench.py --users 10000 --compare bench-results.json
+
+For each scenario it reports p50/p95/p99 latency, throughput and Mongo
+operations per request (from the command listener in metrics.py) as JSON.
+With --compare, it exits non-zero when a scenario's p95 regressed by more
+than --tolerance against an earlier run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("MONGO_DB", "expense_bench")
+# Measure what each route costs, not the admission limits in front of it
+os.environ.setdefault("RATE_LIMITS", "{}")
+
+import httpx
+
+import auth
+import main
+from loadtest import summarize
+from metrics import metrics
+
+CATEGORY_NAMES = ["Food", "Transportation", "Rent", "Utilities", "Entertainment",
+                  "Health", "Shopping", "Travel", "Education", "Gifts"]
+PASSWORD = "bench"
+
+
+def synthetic_months(rng, max_categories, max_sub_categories):
+    months = []
+    for month in main.MONTHS:
+        categories = []
+        for name in CATEGORY_NAMES[:rng.randint(2, max_categories)]:
+            subs = [{"sub_category": f"{name.lower()}-{i}", "amount_spent": rng.randint(1, 50)}
+                    for i in range(rng.randint(0, max_sub_categories))]
+            spent = sum(sub["amount_spent"] for sub in subs)
+            # Food gets enough headroom for the add_subcategory scenario
+            headroom = 10_000_000 if name == "Food" else rng.randint(0, 500)
+            categories.append({"category": name, "total_budget": spent + headroom, "sub_categories": subs})
+        # Seeded with running totals, as the API writes them
+        months.append(main.with_totals({
+            "month": month,
+            "monthly_budget": sum(c["total_budget"] for c in categories),
+            "categories": categories,
+        }))
+    return months
+
+
+async def seed(users, max_categories, max_sub_categories, batch_size, seed_value):
+    rng = random.Random(seed_value)
+    year = main.resolve_year(None)
+    # One hash shared by every user; hashing each one would dominate seeding
+    password_hash = auth.hash_password(PASSWORD)
+    for start in range(0, users, batch_size):
+        ids = [f"bench_{i}" for i in range(start, min(start + batch_size, users))]
+        await main.db.customer_details.insert_many([{"userid": userid, "password": password_hash} for userid in ids])
+        if main.EXPENSE_STORAGE == "monthly":
+            docs = [main.month_document(userid, year, month)
+                    for userid in ids for month in synthetic_months(rng, max_categories, max_sub_categories)]
+            await main.db.expense_months.insert_many(docs)
+        else:
+            await main.db.expenses.insert_many([
+                {"_id": userid, "version": 0, "months": synthetic_months(rng, max_categories, max_sub_categories)}
+                for userid in ids
+            ])
+
+
+def scenarios(users, rng, run_id):
+    def user():
+        return f"bench_{rng.randrange(users)}"
+
+    def month():
+        return rng.choice(main.MONTHS)
+
+    # name -> (method, route template, request builder)
+    return {
+        "register": ("POST", "/register", lambda client, i: client.post("/register", json={
+            "user": {"username": f"new{i}", "email": f"new{i}@example.com", "full_name": f"New {i}"},
+            "customer_details": {"userid": f"bench_new_{run_id}_{i}", "password": PASSWORD},
+        })),
+        "login": ("POST", "/login", lambda client, i: client.post("/login", json={"userid": user(), "password": PASSWORD})),
+        "read_expense": ("GET", "/expenses/{user_id}", lambda client, i: client.get(f"/expenses/{user()}")),
+        "read_month_expense": ("GET", "/expenses/{user_id}/month/{month}",
+                               lambda client, i: client.get(f"/expenses/{user()}/month/{month()}")),
+        "add_subcategory": ("POST", "/expenses/{user_id}/month/{month}/category/{category}",
+                            lambda client, i: client.post(f"/expenses/{user()}/month/{month()}/category/Food",
+                                                          json={"sub_category": f"bench-{i}", "amount_spent": 1})),
+        "modify_budget": ("PUT", "/expenses/{user_id}/modify-budget",
+                          lambda client, i: client.put(f"/expenses/{user()}/modify-budget", params={
+                              "month": month(), "category": "Food", "new_budget": 10_000_000 + rng.randint(0, 1000)})),
+        "leaderboard": ("GET", "/leaderboard", lambda client, i: client.get("/leaderboard", params={"month": month(), "limit": 10})),
+    }
+
+
+def mongo_ops_snapshot(method, route):
+    histogram = metrics.mongo_ops_per_request.get((method, route))
+    return (histogram.sum, histogram.total) if histogram else (0.0, 0)
+
+
+async def run_scenario(client, method, route, build, requests, concurrency):
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+    ops_before = mongo_ops_snapshot(method, route)
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            response = await build(client, i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    ops_after = mongo_ops_snapshot(method, route)
+    measured = ops_after[1] - ops_before[1]
+    ops_per_request = (ops_after[0] - ops_before[0]) / measured if measured else 0.0
+    return {**summarize(latencies, errors, elapsed), "mongo_ops_per_request": round(ops_per_request, 2)}
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get(result["scenario"])
+        if before and before["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append({"scenario": result["scenario"], "baseline_p95_ms": before["p95_ms"], "p95_ms": result["p95_ms"]})
+    return regressions
+
+
+async def run(args):
+    if args.reset:
+        await main.client.drop_database(main.MONGO_DB)
+    await main.ensure_indexes()
+    if args.reset or not await main.db.customer_details.estimated_document_count():
+        started = time.perf_counter()
+        await seed(args.users, args.max_categories, args.max_sub_categories, args.batch_size, args.seed)
+        print(f"Seeded {args.users} users in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    rng = random.Random(args.seed)
+    selected = scenarios(args.users, rng, run_id=int(time.time()))
+    names = args.scenarios or list(selected)
+
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name in names:
+            method, route, build = selected[name]
+            result = await run_scenario(client, method, route, build, args.requests, args.concurrency)
+            results.append({"scenario": name, "concurrency": args.concurrency, **result})
+            print(json.dumps(results[-1]), file=sys.stderr)
+
+    return {
+        "config": {
+            "users": args.users,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "max_categories": args.max_categories,
+            "max_sub_categories": args.max_sub_categories,
+            "seed": args.seed,
+            "storage": main.EXPENSE_STORAGE,
+            "cache": os.getenv("CACHE_BACKEND", "memory"),
+            "materialized_leaderboard": main.MATERIALIZE_LEADERBOARD,
+        },
+        "results": results,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--max-categories", type=int, default=8)
+    parser.add_argument("--max-sub-categories", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reset", action="store_true", help="drop and re-seed the benchmark database")
+    parser.add_argument("--scenarios", nargs="+", choices=["register", "login", "read_expense", "read_month_expense",
+                                                            "add_subcategory", "modify_budget", "leaderboard"])
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--compare", help="earlier JSON report to check p95 regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.compare:
+        report["regressions"] = compare(report["results"], args.compare, args.tolerance)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    sys.exit(1 if report.get("regressions") else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,74 @@
+"""Login throughput at a given scrypt cost.
+
+Verifies one stored hash over and over, first on a single thread and then
+across --workers threads (the same pool size the API uses), and reports
+logins/sec overall and per core. Session-token checks are timed too, since
+they replace password verification on every later request:
+
+    python bench_auth.py --n 16384 --r 8 --p 1 --seconds 5
+
+Pick the largest cost whose per-core rate still covers the expected peak
+login rate, then set SCRYPT_N/SCRYPT_R/SCRYPT_P for the API to match.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import auth
+
+PASSWORD = "correct horse battery staple"
+
+
+def verifications_per_second(stored, seconds):
+    count = 0
+    deadline = time.perf_counter() + seconds
+    started = time.perf_counter()
+    while time.perf_counter() < deadline:
+        auth.verify_password(PASSWORD, stored)
+        count += 1
+    return count, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=auth.SCRYPT_N)
+    parser.add_argument("--r", type=int, default=auth.SCRYPT_R)
+    parser.add_argument("--p", type=int, default=auth.SCRYPT_P)
+    parser.add_argument("--workers", type=int, default=auth.HASH_WORKERS)
+    parser.add_argument("--seconds", type=float, default=5.0, help="duration of each measurement")
+    args = parser.parse_args()
+
+    stored = auth.hash_password(PASSWORD, args.n, args.r, args.p)
+
+    count, elapsed = verifications_per_second(stored, args.seconds)
+    single = count / elapsed
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        started = time.perf_counter()
+        counts = list(pool.map(lambda _: verifications_per_second(stored, args.seconds)[0], range(args.workers)))
+        pooled = sum(counts) / (time.perf_counter() - started)
+
+    token = auth.issue_token("bench")
+    started = time.perf_counter()
+    token_checks = 0
+    while time.perf_counter() - started < 1.0:
+        auth.verify_token(token)
+        token_checks += 1
+
+    cores = min(args.workers, os.cpu_count() or 1)
+    print(json.dumps({
+        "scrypt": {"n": args.n, "r": args.r, "p": args.p, "memory_mib": round(128 * args.n * args.r / 2 ** 20, 1)},
+        "verify_ms": round(1000 / single, 2),
+        "logins_per_second_single_thread": round(single, 1),
+        "workers": args.workers,
+        "cores_used": cores,
+        "logins_per_second_pool": round(pooled, 1),
+        "logins_per_second_per_core": round(pooled / cores, 1),
+        "token_checks_per_second": round(token_checks / (time.perf_counter() - started), 1),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
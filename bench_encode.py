@@ -0,0 +1,94 @@
+"""Encode time and size of one large expense document, per serializer.
+
+Builds a 12-month document with --categories categories of
+--sub-categories line items each, then times each way of turning it into a
+response body:
+
+    python bench_encode.py --categories 50 --sub-categories 5
+
+* fastapi_default: jsonable_encoder + JSONResponse, the path a route takes
+  when it returns a plain dict
+* response_model: validating against ExpenseOut first, the path a route
+  takes when FastAPI checks its response_model
+* json / orjson / msgpack: what FastResponse does, for each backend it can use
+
+Serializers whose package isn't installed are skipped.
+"""
+import argparse
+import json
+import statistics
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+import main
+import responses
+
+
+def synthetic_expense(categories, sub_categories):
+    months = []
+    for month in main.MONTHS:
+        months.append(main.with_totals({
+            "month": month,
+            "version": 1,
+            "monthly_budget": categories * 1000,
+            "categories": [{
+                "category": f"category-{c}",
+                "total_budget": 1000,
+                "sub_categories": [{"sub_category": f"item-{c}-{s}", "amount_spent": s + 1} for s in range(sub_categories)],
+            } for c in range(categories)],
+        }))
+    return {"_id": "bench_user", "version": 1, "months": months}
+
+
+def encoders():
+    def fastapi_default(doc):
+        return JSONResponse(jsonable_encoder(doc)).body
+
+    def response_model(doc):
+        validated = main.ExpenseOut.model_validate(doc).model_dump(mode="json", by_alias=True)
+        return JSONResponse(validated).body
+
+    def stdlib_json(doc):
+        return json.dumps(doc, default=str, ensure_ascii=False, separators=(",", ":")).encode()
+
+    found = {"fastapi_default": fastapi_default, "response_model": response_model, "json": stdlib_json}
+    if responses.orjson is not None:
+        found["orjson"] = responses.encode_json
+    if responses.msgpack is not None:
+        found["msgpack"] = responses.encode_msgpack
+    return found
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--sub-categories", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20, help="encodes per timing run")
+    parser.add_argument("--repeat", type=int, default=7, help="timing runs per serializer")
+    args = parser.parse_args()
+
+    doc = synthetic_expense(args.categories, args.sub_categories)
+    results = []
+    for name, encode in encoders().items():
+        runs = timeit.repeat(lambda: encode(doc), number=args.number, repeat=args.repeat)
+        per_call = [run / args.number for run in runs]
+        results.append({
+            "serializer": name,
+            "median_ms": round(statistics.median(per_call) * 1000, 3),
+            "best_ms": round(min(per_call) * 1000, 3),
+            "bytes": len(encode(doc)),
+        })
+
+    baseline = results[0]["median_ms"]
+    for result in results:
+        result["speedup_vs_fastapi_default"] = round(baseline / result["median_ms"], 1) if result["median_ms"] else None
+    print(json.dumps({
+        "document": {"months": len(main.MONTHS), "categories": args.categories, "sub_categories": args.sub_categories},
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,140 @@
+"""Throughput of the API as uvicorn workers are added on one machine.
+
+Start a local replica set first, so change streams, transactions and
+secondary reads behave as in production, e.g. three members:
+
+    mongod --replSet rs0 --port 27017 --dbpath /tmp/rs0-0 &
+    mongod --replSet rs0 --port 27018 --dbpath /tmp/rs0-1 &
+    mongod --replSet rs0 --port 27019 --dbpath /tmp/rs0-2 &
+    mongosh --eval 'rs.initiate({_id: "rs0", members: [
+        {_id: 0, host: "localhost:27017"}, {_id: 1, host: "localhost:27018"},
+        {_id: 2, host: "localhost:27019"}]})'
+
+then run:
+
+    MONGO_URI="mongodb://localhost:27017/?replicaSet=rs0" \\
+    MONGO_READ_PREFERENCE=secondaryPreferred CACHE_BACKEND=none \\
+        python bench_scale.py --workers 1 2 4 8 --concurrency 200 --clients 4
+
+For each worker count it starts `uvicorn main:app --workers N` with the
+current environment, drives it with the loadtest.py request mix from
+--clients load generator processes (one process saturates before several
+workers do), and reports throughput and its speedup and efficiency against
+the first worker count. Efficiency near 1.0 means near-linear scaling.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import httpx
+
+from loadtest import run_level, seed_users
+
+
+def wait_until_up(base_url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/metrics", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"API at {base_url} did not come up within {timeout}s")
+
+
+@contextmanager
+def serve(args, workers):
+    base_url = f"http://{args.host}:{args.port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", args.host, "--port", str(args.port),
+         "--workers", str(workers), "--log-level", "warning"],
+        # Limits off unless RATE_LIMITS is set, so they don't cap the measurement
+        env={"RATE_LIMITS": "{}", **os.environ},
+    )
+    try:
+        wait_until_up(base_url, args.startup_timeout)
+        yield base_url
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+async def seed(base_url, users):
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        await seed_users(client, users)
+
+
+def generate_load(base_url, users, concurrency, duration):
+    return asyncio.run(run_level(base_url, users, concurrency, duration))
+
+
+def measure(args, users, workers):
+    with serve(args, workers) as base_url:
+        # Warm every worker's connection pool before measuring
+        generate_load(base_url, users, args.concurrency, min(args.duration, 2.0))
+        per_client = max(1, args.concurrency // args.clients)
+        with ProcessPoolExecutor(max_workers=args.clients) as pool:
+            runs = [future.result() for future in [
+                pool.submit(generate_load, base_url, users, per_client, args.duration) for _ in range(args.clients)
+            ]]
+
+    return {
+        "workers": workers,
+        "requests": sum(run["requests"] for run in runs),
+        "errors": sum(run["errors"] for run in runs),
+        "throughput_rps": round(sum(run["throughput_rps"] for run in runs), 1),
+        "p95_ms": max(run["p95_ms"] for run in runs),
+        "p99_ms": max(run["p99_ms"] for run in runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=200, help="open requests in total, across --clients")
+    parser.add_argument("--clients", type=int, default=os.cpu_count() or 1, help="load generator processes")
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--startup-timeout", type=float, default=30.0)
+    parser.add_argument("--skip-seed", action="store_true")
+    args = parser.parse_args()
+
+    users = [f"loadtest_{i}" for i in range(args.users)]
+    if not args.skip_seed:
+        with serve(args, 1) as base_url:
+            asyncio.run(seed(base_url, users))
+
+    results = []
+    for workers in args.workers:
+        result = measure(args, users, workers)
+        baseline = results[0] if results else result
+        speedup = result["throughput_rps"] / baseline["throughput_rps"] if baseline["throughput_rps"] else 0.0
+        result["speedup"] = round(speedup, 2)
+        result["efficiency"] = round(speedup * baseline["workers"] / workers, 2)
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    print(json.dumps({
+        "config": {
+            "concurrency": args.concurrency,
+            "clients": args.clients,
+            "duration": args.duration,
+            "mongo_read_preference": os.getenv("MONGO_READ_PREFERENCE", "primary"),
+            "cache": os.getenv("CACHE_BACKEND", "memory"),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Read-through cache for expense reads.
+
+Two backends share the same async get/set/delete interface:
+
+* LRUCache: in-process, bounded, per-entry TTL. Each uvicorn worker has its
+  own copy, so a write on one worker only invalidates that worker's entries;
+  others see the old value for at most the TTL.
+* RedisCache: wraps any redis.asyncio-compatible client (or a fake such as
+  fakeredis.aioredis.FakeRedis), shared by every worker.
+
+A read-through caller takes generation(key) before loading and passes it to
+set(). If delete() invalidated the key in between, the loaded value may
+predate the write that caused it, and set() drops it (counted as stale_sets)
+instead of caching it for the whole TTL.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_sets = 0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "stale_sets": self.stale_sets,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class LRUCache:
+    backend = "memory"
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        # Keys invalidated at each point of a counter bumped by every delete.
+        # It is bounded like the entries; a generation older than the newest
+        # forgotten invalidation is treated as invalidated.
+        self._clock = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+
+    async def generation(self, key):
+        return self._clock
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    async def set(self, key, value, generation=None):
+        if generation is not None and (
+            generation < self._forgotten or self._invalidated.get(key, -1) >= generation
+        ):
+            self.stats.stale_sets += 1
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def delete(self, *keys):
+        for key in keys:
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self._clock
+            if self._entries.pop(key, None) is not None:
+                self.stats.invalidations += 1
+        self._clock += 1
+        while len(self._invalidated) > self.max_entries:
+            _, invalidated_at = self._invalidated.popitem(last=False)
+            self._forgotten = max(self._forgotten, invalidated_at + 1)
+
+    def size(self):
+        return len(self._entries)
+
+    async def close(self):
+        pass
+
+
+GENERATION_MARGIN_SECONDS = 60
+
+# Set the value only if the key's generation counter is still ARGV[2]
+SET_IF_GENERATION = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[2] then return 0 end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return 1
+"""
+
+
+class RedisCache:
+    backend = "redis"
+
+    def __init__(self, client, ttl=60, prefix="expense-cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats = CacheStats()
+        self._set_if_generation = client.register_script(SET_IF_GENERATION)
+
+    def _generation_key(self, key):
+        return f"{self.prefix}generation:{key}"
+
+    async def generation(self, key):
+        raw = await self.client.get(self._generation_key(key))
+        if raw is None:
+            return "0"
+        return raw.decode() if isinstance(raw, bytes) else str(raw)
+
+    async def get(self, key):
+        raw = await self.client.get(self.prefix + key)
+        if raw is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return json.loads(raw)
+
+    async def set(self, key, value, generation=None):
+        if generation is None:
+            await self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+            return
+        stored = await self._set_if_generation(
+            keys=[self.prefix + key, self._generation_key(key)],
+            args=[json.dumps(value), generation, self.ttl],
+        )
+        if not stored:
+            self.stats.stale_sets += 1
+
+    async def delete(self, *keys):
+        if not keys:
+            return
+        # The generation outlives any value cached before it, plus a margin
+        # for reads still loading when it was bumped
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(*(self.prefix + key for key in keys))
+            for key in keys:
+                pipe.incr(self._generation_key(key))
+                pipe.expire(self._generation_key(key), self.ttl + GENERATION_MARGIN_SECONDS)
+            results = await pipe.execute()
+        self.stats.invalidations += results[0]
+
+    def size(self):
+        return None
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class NullCache:
+    backend = "none"
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    async def generation(self, key):
+        return None
+
+    async def get(self, key):
+        self.stats.misses += 1
+        return None
+
+    async def set(self, key, value, generation=None):
+        pass
+
+    async def delete(self, *keys):
+        pass
+
+    def size(self):
+        return 0
+
+    async def close(self):
+        pass
+
+
+# CACHE_BACKEND=memory (default) | redis | none
+def make_cache():
+    backend = os.getenv("CACHE_BACKEND", "memory")
+    ttl = int(os.getenv("CACHE_TTL_SECONDS", "60"))
+    if backend == "none":
+        return NullCache()
+    if backend == "redis":
+        import redis.asyncio as redis
+
+        return RedisCache(redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")), ttl=ttl)
+    return LRUCache(max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "10000")), ttl=ttl)
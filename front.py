@@ -1,9 +1,8 @@
 import streamlit as st
-import requests
 import pandas as pd
 from datetime import datetime
 
-BASE_URL = "http://127.0.0.1:8000"
+import api_client as api
 
 def main():
     st.title("Gamified Expense Tracker")
@@ -25,10 +24,11 @@ def login_page():
     userid = st.text_input("User ID")
     password = st.text_input("Password", type="password")
     if st.button("Login"):
-        response = requests.post(f"{BASE_URL}/login", json={"userid": userid, "password": password})
+        response = api.post("/login", json={"userid": userid, "password": password})
         if response.status_code == 200:
             st.success("Login successful!")
             st.session_state.user_id = userid
+            st.session_state.session_token = response.json().get("token")
         else:
             st.error("Invalid credentials")
 
@@ -42,44 +42,59 @@ def register_page():
     if st.button("Register"):
         user_data = {"username": username, "email": email, "full_name": full_name}
         customer_details = {"userid": userid, "password": password}
-        response = requests.post(f"{BASE_URL}/register", json={"user": user_data, "customer_details": customer_details})
+        response = api.post("/register", json={"user": user_data, "customer_details": customer_details})
         if response.status_code == 200:
             st.success("Registration successful!")
         else:
             st.error("Registration failed")
+# Every edit is a PATCH /expenses/{user_id} batch, guarded by the ETag the
+# dashboard last read so it can't silently overwrite a change made elsewhere
+def apply_operations(user_id, operations):
+    cached = st.session_state.get("expenses_cache")
+    headers = {"If-Match": cached["etag"]} if cached and cached["user_id"] == user_id and cached["etag"] else {}
+    response = api.patch(f"/expenses/{user_id}", json={"operations": operations}, headers=headers)
+    if response.status_code == 200:
+        invalidate_expenses(response.json().get("version"))
+    if response.status_code == 412:
+        invalidate_expenses()
+        st.warning("Your expenses were changed elsewhere and have been reloaded. Please try again.")
+    return response
+
 def add_category(user_id, month, new_category, total_budget):
-    category_data = {
+    response = apply_operations(user_id, [{
+        "op": "add_category",
+        "month": month,
         "category": new_category,
         "total_budget": total_budget,
-        "sub_categories": []
-    }
-    response = requests.post(f"{BASE_URL}/expenses/{user_id}/month/{month}", json=category_data)
+    }])
     if response.status_code == 200:
         st.success("Expense added successfully!")
-    else:
+    elif response.status_code != 412:
         st.error("Failed to add category")
 
 def add_subcategory(user_id, month, category, new_subcategory, amount_spent):
-    subcategory_data = {
+    response = apply_operations(user_id, [{
+        "op": "add_subcategory",
+        "month": month,
+        "category": category,
         "sub_category": new_subcategory,
-        "amount_spent": amount_spent
-    }
-    response = requests.post(f"{BASE_URL}/expenses/{user_id}/month/{month}/category/{category}", json=subcategory_data)
+        "amount_spent": amount_spent,
+    }])
     if response.status_code == 200:
         st.success("Expense added successfully!")
     elif response.status_code == 400:
         st.error("Failed to add Expense: Budget exceeded")
-    else:
+    elif response.status_code != 412:
         st.error("Failed to add Expense")
 
 def modify_budget(user_id, month, category, new_budget):
-    response = requests.put(f"{BASE_URL}/expenses/{user_id}/modify-budget", 
-                            params={"month": month, "category": category, "new_budget": new_budget})
+    response = apply_operations(user_id, [{"op": "modify_budget", "month": month, "category": category, "new_budget": new_budget}])
     if response.status_code == 200:
         st.success("Budget modified successfully!")
         return True
     else:
-        st.error("Failed to modify budget")
+        if response.status_code != 412:
+            st.error("Failed to modify budget")
         return False
 
 def get_previous_month(current_month):
@@ -89,22 +104,115 @@ def get_previous_month(current_month):
     previous_index = (current_index - 1) % 12
     return months[previous_index]
 
+# Fields the dashboard renders; everything else stays on the server
+SUMMARY_FIELDS = "month,monthly_budget,amount_spent,remaining_budget"
+MONTH_FIELDS = SUMMARY_FIELDS + ",categories.category,categories.total_budget,categories.amount_spent,categories.remaining_budget"
+SUBCATEGORY_PAGE_SIZE = 20
+
+MEMO_MAX_ENTRIES = 64
+
+# Everything the dashboard fetched is kept in session_state and reused on
+# every rerun until a successful mutation (or a live update) calls this. Memo
+# keys include the server versions the data was read at, so after the next
+# revalidation a changed month simply misses and unchanged ones still hit.
+# Reads send the versions already known as min_version, so an API reading
+# from a lagging secondary falls back to the primary instead of returning
+# data from before the change.
+def invalidate_expenses(min_version=None):
+    st.session_state.expenses_stale = True
+    if min_version is not None:
+        st.session_state.expenses_min_version = max(min_version, st.session_state.get("expenses_min_version", 0))
+
+def memoized(key, loader):
+    memo = st.session_state.setdefault("expenses_memo", {})
+    if key not in memo:
+        value = loader()
+        if value is None:
+            return None
+        if len(memo) >= MEMO_MAX_ENTRIES:
+            memo.pop(next(iter(memo)))
+        memo[key] = value
+    return memo[key]
+
+def fetch_month(user_id, month, compare, version, compare_version):
+    def load():
+        response = api.get(f"/expenses/{user_id}/month/{month}", params={
+            "fields": MONTH_FIELDS, "compare": compare, "min_version": version, "compare_min_version": compare_version,
+        })
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        data["categories_by_name"] = {c["category"]: c for c in data.get("categories", [])}
+        return data
+    return memoized(("month", user_id, month, compare, version, compare_version), load)
+
+def fetch_subcategories(user_id, month, category, cursor, version):
+    def load():
+        response = api.get(f"/expenses/{user_id}/month/{month}/category/{category}/subcategories",
+                           params={"limit": SUBCATEGORY_PAGE_SIZE, "cursor": cursor, "min_version": version})
+        return response.json() if response.status_code == 200 else None
+    return memoized(("subcategories", user_id, month, category, cursor, version), load)
+
+# Previous/next buttons over a category's sub-categories; the cursors of the
+# pages already visited are kept so "Previous" can go back
+def subcategory_page(user_id, month, category, version):
+    key = f"subcategory_cursors_{month}_{category}"
+    cursors = st.session_state.setdefault(key, [0])
+    page = fetch_subcategories(user_id, month, category, cursors[-1], version)
+    if page is None:
+        return None
+
+    col1, col2 = st.columns(2)
+    with col1:
+        if len(cursors) > 1 and st.button("Previous", key=f"prev_{key}"):
+            cursors.pop()
+            st.experimental_rerun()
+    with col2:
+        if page["next_cursor"] is not None and st.button("Next", key=f"next_{key}"):
+            cursors.append(page["next_cursor"])
+            st.experimental_rerun()
+    return page
+
+# One table for the page of line items and a single delete control, instead
+# of a row of columns and a button per item
+def display_subcategories(user_id, month, category, page):
+    subcategories = page["sub_categories"] if page else []
+    if not subcategories:
+        st.write("No Expense found for this category.")
+        return
+
+    st.caption(f"{len(subcategories)} of {page['total_sub_categories']} expenses")
+    st.dataframe(pd.DataFrame(subcategories).rename(columns={"sub_category": "Expense", "amount_spent": "Amount"}),
+                 hide_index=True, use_container_width=True)
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        to_delete = st.selectbox("Expense to delete", [sub["sub_category"] for sub in subcategories],
+                                 key=f"del_sub_choice_{month}_{category}")
+    with col2:
+        if st.button("Delete", key=f"del_sub_{month}_{category}"):
+            delete_subcategory(user_id, month, category, to_delete)
+
 def display_expenses(expenses, user_id):
-    months = expenses.get("months", [])
-    if not months:
+    month_names = expenses["month_names"]
+    if not month_names:
         st.write("No expenses found for the user.")
         return
+    months_by_name = expenses["months_by_name"]
 
     current_month = datetime.now().strftime("%B")
-    selected_month = st.selectbox("Select Month", [month['month'] for month in months], 
-                                  index=[month['month'] for month in months].index(current_month) 
-                                  if current_month in [month['month'] for month in months] else 0)
+    selected_month = st.selectbox("Select Month", month_names,
+                                  index=month_names.index(current_month) if current_month in months_by_name else 0)
 
     # Analysis section
     st.subheader("Monthly Spending Analysis")
-    current_month_data = next((month for month in months if month['month'] == selected_month), None)
     previous_month = get_previous_month(selected_month)
-    previous_month_data = next((month for month in months if month['month'] == previous_month), None)
+    current_month_data = fetch_month(user_id, selected_month, previous_month,
+                                     months_by_name[selected_month].get("version"),
+                                     months_by_name.get(previous_month, {}).get("version"))
+    if current_month_data is None:
+        st.error("Failed to fetch expenses")
+        return
+    previous_month_data = current_month_data.get("comparison")
 
     if current_month_data and previous_month_data:
         current_spent = current_month_data.get('amount_spent', 0)
@@ -124,65 +232,51 @@ def display_expenses(expenses, user_id):
         else:
             st.info("Your spending is consistent with last month.")
 
-    # Original display_expenses content
-    for month in months:
-        if month['month'] == selected_month:
-            st.write(f"Monthly Budget: ${month.get('monthly_budget', 'N/A')}")
-            st.write(f"Amount Spent: ${month.get('amount_spent', 'N/A')}")
-            
-            categories = month.get("categories", [])
-            if not categories:
-                st.write("No categories found for this month.")
-                continue
-
-            selected_category = st.selectbox("Select Category", [category['category'] for category in categories])
-
-            for category in categories:
-                if category['category'] == selected_category:
-                    total_budget = category.get('total_budget', 0)
-                    st.write(f"Total Budget: ${total_budget}")
-                    
-                    new_budget = st.number_input(f"Modify budget for {selected_category}", 
-                                                 value=float(total_budget), 
-                                                 min_value=0.0, 
-                                                 format="%.2f")
-                    if st.button("Update Budget", key=f"update_budget_{selected_category}"):
-                        if modify_budget(user_id, selected_month, selected_category, int(new_budget)):
-                            st.experimental_rerun()
-                    
-                    subcategories = category.get("sub_categories", [])
-                    current_spent = sum(sub['amount_spent'] for sub in subcategories)
-                    st.write(f"Current Spent: ${current_spent}")
-                    st.write(f"Remaining Budget: ${max(total_budget - current_spent, 0)}")
-
-                    if not subcategories:
-                        st.write("No Expense found for this category.")
-                    else:
-                        for subcategory in subcategories:
-                            col1, col2, col3 = st.columns([3, 1, 1])
-                            with col1:
-                                st.write(f"Expense: {subcategory.get('sub_category', 'Unknown')}")
-                            with col2:
-                                st.write(f"Amount: ${subcategory.get('amount_spent', 'N/A')}")
-                            with col3:
-                                if st.button("Delete", key=f"del_sub_{subcategory.get('sub_category', '')}_{selected_month}_{selected_category}"):
-                                    delete_subcategory(user_id, selected_month, selected_category, subcategory.get('sub_category', ''))
-
-                    if st.button("Delete Category", key=f"del_cat_{selected_category}_{selected_month}"):
-                        delete_category(user_id, selected_month, selected_category)
-                    
-                    if current_spent < total_budget:
-                        new_subcategory = st.text_input(f"New Expense for {selected_category}")
-                        amount_spent = st.number_input(f"Amount Spent for {new_subcategory}", min_value=0.0, max_value=float(total_budget - current_spent), format="%.2f")
-                        if st.button("Add Expense", key=f"add_sub_{selected_category}_{selected_month}"):
-                            add_subcategory(user_id, selected_month, selected_category, new_subcategory, amount_spent)
-                    else:
-                        st.warning("Category budget is fully spent. Cannot add more expenses.")
-
-            new_category = st.text_input(f"New Category for {selected_month}")
-            new_category_budget = st.number_input(f"Budget for {new_category}", min_value=0.0, format="%.2f")
-            if st.button("Add Category", key=f"add_cat_{selected_month}"):
-                add_category(user_id, selected_month, new_category, new_category_budget)
+    month = current_month_data
+    st.write(f"Monthly Budget: ${month.get('monthly_budget', 'N/A')}")
+    st.write(f"Amount Spent: ${month.get('amount_spent', 'N/A')}")
+
+    categories_by_name = month["categories_by_name"]
+    if not categories_by_name:
+        st.write("No categories found for this month.")
+    else:
+        selected_category = st.selectbox("Select Category", list(categories_by_name))
+        category = categories_by_name[selected_category]
+
+        total_budget = category.get('total_budget', 0)
+        st.write(f"Total Budget: ${total_budget}")
+
+        new_budget = st.number_input(f"Modify budget for {selected_category}", 
+                                     value=float(total_budget), 
+                                     min_value=0.0, 
+                                     format="%.2f")
+        if st.button("Update Budget", key=f"update_budget_{selected_category}"):
+            if modify_budget(user_id, selected_month, selected_category, int(new_budget)):
+                st.experimental_rerun()
+
+        current_spent = category.get('amount_spent', 0)
+        remaining_budget = category.get('remaining_budget', total_budget - current_spent)
+        st.write(f"Current Spent: ${current_spent}")
+        st.write(f"Remaining Budget: ${max(remaining_budget, 0)}")
+
+        page = subcategory_page(user_id, selected_month, selected_category, month.get("version"))
+        display_subcategories(user_id, selected_month, selected_category, page)
+
+        if st.button("Delete Category", key=f"del_cat_{selected_category}_{selected_month}"):
+            delete_category(user_id, selected_month, selected_category)
+
+        if remaining_budget > 0:
+            new_subcategory = st.text_input(f"New Expense for {selected_category}")
+            amount_spent = st.number_input(f"Amount Spent for {new_subcategory}", min_value=0.0, max_value=float(remaining_budget), format="%.2f")
+            if st.button("Add Expense", key=f"add_sub_{selected_category}_{selected_month}"):
+                add_subcategory(user_id, selected_month, selected_category, new_subcategory, amount_spent)
+        else:
+            st.warning("Category budget is fully spent. Cannot add more expenses.")
+
+    new_category = st.text_input(f"New Category for {selected_month}")
+    new_category_budget = st.number_input(f"Budget for {new_category}", min_value=0.0, format="%.2f")
+    if st.button("Add Category", key=f"add_cat_{selected_month}"):
+        add_category(user_id, selected_month, new_category, new_category_budget)
 
 def dashboard_page():
     if "user_id" not in st.session_state:
@@ -191,26 +285,98 @@ def dashboard_page():
 
     st.header("Dashboard")
     user_id = st.session_state.user_id
-    response = requests.get(f"{BASE_URL}/expenses/{user_id}")
-    if response.status_code == 200:
-        expenses = response.json()
+    live = st.sidebar.checkbox("Live updates", key="live_dashboard")
+    if st.sidebar.button("Refresh"):
+        invalidate_expenses()
+    expenses = fetch_expenses(user_id)
+    if expenses is not None:
         display_expenses(expenses, user_id)
     else:
         st.error("Failed to fetch expenses")
+        return
+
+    changed = live and wait_for_change(f"/expenses/{user_id}/wait", {"since": expenses["data"].get("version", 0)})
+    if changed:
+        invalidate_expenses(changed.json().get("version"))
+        st.experimental_rerun()
+
+# Hold a request open until the server reports a change, instead of polling.
+# Each wait lasts at most LIVE_WAIT_SECONDS; Streamlit can only stop the script
+# between st calls, so a click may take that long to register.
+LIVE_WAIT_SECONDS = 10
+
+def wait_for_change(path, params, headers=None):
+    status = st.empty()
+    while True:
+        status.caption(f"Live updates on, checked at {datetime.now():%H:%M:%S}")
+        response = api.get(path, params={**params, "timeout": LIVE_WAIT_SECONDS}, headers=headers or {},
+                           timeout=(api.CONNECT_TIMEOUT, LIVE_WAIT_SECONDS + api.READ_TIMEOUT))
+        if response.status_code == 200:
+            return response
+        if response.status_code != 304:
+            status.caption("Live updates unavailable")
+            return None
+
+# Month totals only, for the month picker, plus an index by month name.
+# Reused without a request until invalidate_expenses(); then revalidated: 304
+# keeps the copy, otherwise only the months changed since its version are
+# downloaded and merged in.
+def fetch_expenses(user_id):
+    cached = st.session_state.get("expenses_cache")
+    if cached and cached["user_id"] == user_id:
+        if not st.session_state.get("expenses_stale"):
+            return cached
+        response = api.get(f"/expenses/{user_id}",
+                                params={"fields": SUMMARY_FIELDS, "since": cached["data"].get("version", 0),
+                                        "min_version": st.session_state.get("expenses_min_version")},
+                                headers={"If-None-Match": cached["etag"]})
+        if response.status_code == 304:
+            st.session_state.expenses_stale = False
+            return cached
+        if response.status_code == 200:
+            delta = response.json()
+            changed = {m["month"]: m for m in delta["months"]}
+            data = dict(cached["data"], version=delta["version"],
+                        months=[changed.get(m["month"], m) for m in cached["data"]["months"]])
+            return store_expenses(user_id, response.headers.get("ETag"), data)
+        return None
+
+    response = api.get(f"/expenses/{user_id}", params={"fields": SUMMARY_FIELDS})
+    if response.status_code != 200:
+        return None
+    return store_expenses(user_id, response.headers.get("ETag"), response.json())
+
+def store_expenses(user_id, etag, data):
+    months = data.get("months", [])
+    cached = {
+        "user_id": user_id,
+        "etag": etag,
+        "data": data,
+        "month_names": [m["month"] for m in months],
+        "months_by_name": {m["month"]: m for m in months},
+    }
+    st.session_state.expenses_cache = cached
+    st.session_state.expenses_stale = False
+    return cached
 
 
 def delete_category(user_id, month, category):
-    response = requests.delete(f"{BASE_URL}/expenses/{user_id}/month/{month}/category/{category}")
+    response = apply_operations(user_id, [{"op": "delete_category", "month": month, "category": category}])
     if response.status_code == 200:
         st.success("Category deleted successfully!")
-    else:
+    elif response.status_code != 412:
         st.error("Failed to delete category")
 
 def delete_subcategory(user_id, month, category, sub_category):
-    response = requests.delete(f"{BASE_URL}/expenses/{user_id}/month/{month}/category/{category}/subcategory/{sub_category}")
+    response = apply_operations(user_id, [{
+        "op": "delete_subcategory",
+        "month": month,
+        "category": category,
+        "sub_category": sub_category,
+    }])
     if response.status_code == 200:
         st.success("Subcategory deleted successfully!")
-    else:
+    elif response.status_code != 412:
         st.error("Failed to delete subcategory")
 
 
@@ -220,13 +386,30 @@ def leaderboard_page():
     months = ['January', 'February', 'March', 'April', 'May', 'June', 
               'July', 'August', 'September', 'October', 'November', 'December']
     selected_month = st.selectbox("Select Month", months)
-    
-    response = requests.get(f"{BASE_URL}/leaderboard", params={"month": selected_month})
-    if response.status_code == 200:
-        leaderboard_data = response.json()
-        display_leaderboard(leaderboard_data)
-    else:
+    live = st.sidebar.checkbox("Live updates", key="live_leaderboard")
+
+    # The copy from the last wait is current; otherwise revalidate it by ETag
+    cached = st.session_state.get("leaderboard_cache")
+    if not (cached and cached["month"] == selected_month):
+        cached = None
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+    if not (live and cached):
+        response = api.get("/leaderboard", params={"month": selected_month}, headers=headers)
+        if response.status_code == 200:
+            cached = {"month": selected_month, "etag": response.headers.get("ETag"), "data": response.json()}
+            st.session_state.leaderboard_cache = cached
+        elif response.status_code != 304:
+            cached = None
+    if cached is None:
         st.warning(f"Leaderboard data for {selected_month} is not available.")
+        return
+    display_leaderboard(cached["data"])
+
+    if live:
+        response = wait_for_change("/leaderboard/wait", {"month": selected_month}, {"If-None-Match": cached["etag"]})
+        if response is not None:
+            st.session_state.leaderboard_cache = {"month": selected_month, "etag": response.headers.get("ETag"), "data": response.json()}
+            st.experimental_rerun()
 
 
 def display_leaderboard(leaderboard_data):
@@ -0,0 +1,191 @@
+"""Live push of expense and leaderboard changes to connected clients.
+
+Each process runs one LiveHub. It follows a single change stream over the
+database and fans the changes out to every subscriber, so a thousand open
+dashboards cost one cursor rather than a thousand polling loops:
+
+* expense subscribers are keyed by (user_id, year). When that user's data
+  changes, the hub loads the document once and offers it to every
+  subscriber, who turns it into a ?since= style delta for its own client.
+* leaderboard subscribers are keyed by (month, year, limit). After a change
+  the hub recomputes each subscribed leaderboard (at most once every
+  LIVE_LEADERBOARD_SECONDS) and only pushes the ones whose entries moved.
+
+Change streams need a replica set. When opening one fails (a standalone
+mongod, a local stand-in), the hub polls the subscribed users' version
+counters every LIVE_POLL_SECONDS instead, and tries the change stream again
+after LIVE_RETRY_WATCH_SECONDS.
+
+The storage-specific parts (what to watch, how to load a user or a
+leaderboard, how to read versions) are callables passed in by main.py.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("live")
+
+
+# Subscribers only ever need the newest value, so a slow client's queue
+# holds one item and older ones are dropped
+def offer(queue, item):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+
+class LiveHub:
+    def __init__(self, watch_changes, load_expense, load_leaderboard, poll_versions,
+                 coalesce_seconds=0.1, poll_seconds=2.0, leaderboard_seconds=2.0, retry_watch_seconds=60.0):
+        self.watch_changes = watch_changes
+        self.load_expense = load_expense
+        self.load_leaderboard = load_leaderboard
+        self.poll_versions = poll_versions
+        self.coalesce_seconds = coalesce_seconds
+        self.poll_seconds = poll_seconds
+        self.leaderboard_seconds = leaderboard_seconds
+        self.retry_watch_seconds = retry_watch_seconds
+        self.mode = None
+        self.users = defaultdict(set)
+        self.leaderboards = defaultdict(set)
+        self.last_leaderboards = {}
+        self._dirty_users = set()
+        self._leaderboards_dirty = False
+        self._versions = {}
+        self._wake = None
+        self._tasks = []
+
+    # Started by the first subscriber, on the event loop serving it. The tasks
+    # get an empty context rather than a copy of that request's, so its
+    # current_request and profile don't collect the hub's queries forever.
+    def start(self):
+        if not self._tasks:
+            self._wake = asyncio.Event()
+            self._tasks = [
+                asyncio.create_task(self._follow(), context=contextvars.Context()),
+                asyncio.create_task(self._flush(), context=contextvars.Context()),
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.mode = None
+
+    @asynccontextmanager
+    async def _subscribe(self, registry, key):
+        self.start()
+        queue = asyncio.Queue(maxsize=1)
+        registry[key].add(queue)
+        try:
+            yield queue
+        finally:
+            registry[key].discard(queue)
+            if not registry[key]:
+                del registry[key]
+
+    def subscribe_expense(self, key):
+        return self._subscribe(self.users, key)
+
+    def subscribe_leaderboard(self, key):
+        return self._subscribe(self.leaderboards, key)
+
+    # kind is "expense" (key is the (user_id, year) that changed) or
+    # "leaderboard" (anything that can move a ranking)
+    def mark(self, kind, key=None):
+        if kind == "expense":
+            self._dirty_users.add(key)
+        else:
+            self._leaderboards_dirty = True
+        self._wake.set()
+
+    async def _follow(self):
+        while True:
+            try:
+                self.mode = "change_stream"
+                async for kind, key in self.watch_changes():
+                    self.mark(kind, key)
+            except Exception as e:
+                logger.warning("Change stream unavailable (%s); polling every %.1fs", e, self.poll_seconds)
+            self.mode = "polling"
+            deadline = time.monotonic() + self.retry_watch_seconds
+            while time.monotonic() < deadline:
+                await self._poll()
+                await asyncio.sleep(self.poll_seconds)
+
+    async def _poll(self):
+        try:
+            if self.users:
+                for key, version in (await self.poll_versions(list(self.users))).items():
+                    if self._versions.get(key) != version:
+                        self._versions[key] = version
+                        self.mark("expense", key)
+            # Other users' writes move rankings too, and polling can't see them
+            if self.leaderboards:
+                self.mark("leaderboard")
+        except Exception:
+            logger.exception("Polling for expense changes failed")
+
+    async def _flush(self):
+        next_leaderboards = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.leaderboard_seconds)
+                # Let the rest of a multi-statement write land before loading
+                await asyncio.sleep(self.coalesce_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+            dirty, self._dirty_users = self._dirty_users, set()
+            for key in dirty:
+                if self.users.get(key):
+                    try:
+                        expense = await self.load_expense(key)
+                    except Exception:
+                        logger.exception("Loading %r for live subscribers failed", key)
+                        continue
+                    for queue in list(self.users.get(key, ())):
+                        offer(queue, expense)
+
+            if self._leaderboards_dirty and time.monotonic() >= next_leaderboards:
+                self._leaderboards_dirty = False
+                next_leaderboards = time.monotonic() + self.leaderboard_seconds
+                await self._push_leaderboards()
+
+    async def _push_leaderboards(self):
+        for key in list(self.leaderboards):
+            try:
+                entries = await self.load_leaderboard(key)
+            except Exception:
+                logger.exception("Loading leaderboard %r for live subscribers failed", key)
+                continue
+            if entries != self.last_leaderboards.get(key):
+                self.last_leaderboards[key] = entries
+                for queue in list(self.leaderboards.get(key, ())):
+                    offer(queue, entries)
+        for key in list(self.last_leaderboards):
+            if key not in self.leaderboards:
+                del self.last_leaderboards[key]
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "expense_subscribers": sum(len(queues) for queues in self.users.values()),
+            "leaderboard_subscribers": sum(len(queues) for queues in self.leaderboards.values()),
+        }
+
+    def metric_lines(self):
+        stats = self.stats()
+        return [
+            "# HELP live_subscribers Open live-update connections",
+            "# TYPE live_subscribers gauge",
+            f'live_subscribers{{kind="expense"}} {stats["expense_subscribers"]}',
+            f'live_subscribers{{kind="leaderboard"}} {stats["leaderboard_subscribers"]}',
+            "# TYPE live_change_stream gauge",
+            f"live_change_stream {1 if stats['mode'] == 'change_stream' else 0}",
+        ]
@@ -0,0 +1,93 @@
+"""Concurrency load test for the expense API.
+
+Start the API first (e.g. `uvicorn main:app --workers 1`) against a local
+mongod, with RATE_LIMITS='{}' unless the admission limits are what you want
+to measure, then run:
+
+    python loadtest.py --base-url http://127.0.0.1:8000 --concurrency 50 200 1000
+
+Each level keeps N clients busy for --duration seconds with a mix of
+dashboard reads and leaderboard calls, and prints throughput and latency.
+Run it against the previous (synchronous) build to compare.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+import httpx
+
+
+async def seed_users(client, users):
+    for userid in users:
+        await client.post("/register", json={
+            "user": {"username": userid, "email": f"{userid}@example.com", "full_name": userid},
+            "customer_details": {"userid": userid, "password": "loadtest"},
+        })
+
+
+async def run_level(base_url, users, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                userid = random.choice(users)
+                if random.random() < 0.9:
+                    request = client.get(f"/expenses/{userid}")
+                else:
+                    request = client.get("/leaderboard", params={"month": "January", "limit": 10})
+                start = time.perf_counter()
+                try:
+                    response = await request
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {"concurrency": concurrency, **summarize(latencies, errors, elapsed)}
+
+
+def summarize(latencies, errors, elapsed):
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else (latencies or [0.0]) * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(quantiles[49] * 1000, 2),
+        "p95_ms": round(quantiles[94] * 1000, 2),
+        "p99_ms": round(quantiles[98] * 1000, 2),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--skip-seed", action="store_true")
+    args = parser.parse_args()
+
+    users = [f"loadtest_{i}" for i in range(args.users)]
+    if not args.skip_seed:
+        async with httpx.AsyncClient(base_url=args.base_url, timeout=30) as client:
+            await seed_users(client, users)
+
+    for concurrency in args.concurrency:
+        print(json.dumps(await run_level(args.base_url, users, concurrency, args.duration)))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
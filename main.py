@@ -1,13 +1,173 @@
-from fastapi import FastAPI, APIRouter, HTTPException
-from pydantic import BaseModel
-from pymongo import MongoClient
+import asyncio
+import codecs
+import copy
+import csv
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import sys
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Literal, NamedTuple, Optional
+
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Query, Header, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from pymongo import AsyncMongoClient, ASCENDING, DESCENDING, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
 from bson import ObjectId
 
-app = FastAPI()
+import auth
+import profiling
+from cache import make_cache
+from live import LiveHub
+from responses import FastResponse, NegotiationMiddleware, encode_json
+from metrics import metrics, MetricsMiddleware, MongoCommandListener
+from ratelimit import make_limiter
+from tasks import job, make_queue
+
+# Everything a worker process holds open lives between startup and shutdown
+# here. An app started again after shutdown (e.g. by a second TestClient)
+# opens a new Mongo client, since a closed one can't be reused.
+@asynccontextmanager
+async def lifespan(app):
+    if client is None:
+        connect()
+    await ensure_indexes()
+    await task_queue.start()
+    background = []
+    if RECONCILE_INTERVAL_SECONDS > 0:
+        background.append(asyncio.create_task(reconcile_periodically()))
+    if ANALYTICS_SNAPSHOT and ANALYTICS_REFRESH_SECONDS > 0:
+        background.append(asyncio.create_task(refresh_analytics_periodically()))
+    yield
+    for task in background:
+        task.cancel()
+    await live_hub.stop()
+    await task_queue.stop()
+    await expense_cache.close()
+    await limiter.close()
+    await disconnect()
+
 router = APIRouter()
+# Operator routes (/admin/*, /diagnostics/*), only served with X-Admin-Token
+admin_router = APIRouter()
+logger = logging.getLogger("expense")
+
+# Requests slower than this are logged with their Mongo op count; unset = off
+SLOW_REQUEST_MS = os.getenv("SLOW_REQUEST_MS")
+
+# Connection settings, overridable per deployment
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+MONGO_DB = os.getenv("MONGO_DB", "expense")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+
+# Read preference for the read-heavy routes (e.g. "secondaryPreferred",
+# "nearest"); writes and everything else always go to the primary. Secondary
+# reads can lag the primary's writes by the replication lag, bounded by
+# MONGO_MAX_STALENESS_SECONDS (-1 = no bound, otherwise at least 90). Reads
+# that pass ?min_version= fall back to the primary when a secondary is behind.
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+MONGO_MAX_STALENESS_SECONDS = int(os.getenv("MONGO_MAX_STALENESS_SECONDS", "-1"))
+
+# Async driver: every query is awaited, so one worker keeps serving other
+# requests while Mongo is busy. The client only connects on its first
+# operation, so creating it at import is safe before uvicorn starts workers;
+# each worker process gets its own client and pool.
+client = db = read_db = None
+
+def connect():
+    global client, db, read_db
+    client = AsyncMongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        event_listeners=[MongoCommandListener()],
+    )
+    db = client[MONGO_DB]
+    read_db = client.get_database(MONGO_DB, read_preference=make_read_preference(
+        read_pref_mode_from_name(MONGO_READ_PREFERENCE), None, MONGO_MAX_STALENESS_SECONDS,
+    ))
+
+async def disconnect():
+    global client
+    if client is not None:
+        await client.close()
+        client = None
+
+connect()
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June',
+          'July', 'August', 'September', 'October', 'November', 'December']
+
+# Keep a leaderboard_<month> collection per month up to date on every write,
+# so /leaderboard becomes an indexed, paginated read instead of an aggregation.
+MATERIALIZE_LEADERBOARD = os.getenv("MATERIALIZE_LEADERBOARD", "0") == "1"
+
+# Bulk uploads are written every BULK_FLUSH_ROWS accepted rows, and at most
+# BULK_MAX_ERRORS row errors are echoed back, so memory stays flat
+BULK_FLUSH_ROWS = int(os.getenv("BULK_FLUSH_ROWS", "5000"))
+BULK_MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", "1000"))
+
+# How often the running totals are checked against the line items; 0 = never
+RECONCILE_INTERVAL_SECONDS = int(os.getenv("RECONCILE_INTERVAL_SECONDS", "3600"))
+RECONCILE_STARTUP_LEASE_SECONDS = 60
+
+# Cross-user analytics are served from a Parquet snapshot (see analytics.py)
+# that is refreshed for changed users every ANALYTICS_REFRESH_SECONDS
+ANALYTICS_SNAPSHOT = os.getenv("ANALYTICS_SNAPSHOT", "0") == "1"
+ANALYTICS_REFRESH_SECONDS = int(os.getenv("ANALYTICS_REFRESH_SECONDS", "300"))
+ANALYTICS_REFRESH_BATCH = int(os.getenv("ANALYTICS_REFRESH_BATCH", "10000"))
+# How long the worker that last refreshed stays the only one allowed to
+# refresh; at least as long as a full rebuild is expected to take
+ANALYTICS_LEASE_SECONDS = max(ANALYTICS_REFRESH_SECONDS * 2, 600)
+if ANALYTICS_SNAPSHOT:
+    import analytics
 
-client = MongoClient("mongodb://localhost:27017")
-db = client.expense
+# "embedded": one expenses document per user holding all twelve months.
+# "monthly": one expense_months document per (user, year, month), so each read
+# or write only ships the month it needs. Convert with migrate_expenses.py.
+EXPENSE_STORAGE = os.getenv("EXPENSE_STORAGE", "embedded")
+
+# With REQUIRE_SESSION=1, routes under /expenses/{user_id} only accept the
+# session token /login issued to that user
+REQUIRE_SESSION = os.getenv("REQUIRE_SESSION", "0") == "1"
+
+# Secret that admin_router routes require in X-Admin-Token; unset, they are off
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Live updates (see live.py): how long /wait requests may be held, and how
+# often the SSE streams send a keepalive comment
+LIVE_MAX_WAIT_SECONDS = float(os.getenv("LIVE_MAX_WAIT_SECONDS", "30"))
+LIVE_KEEPALIVE_SECONDS = float(os.getenv("LIVE_KEEPALIVE_SECONDS", "15"))
+
+# How long PATCH Idempotency-Keys are remembered, and how often a PATCH in
+# embedded storage re-reads and retries after losing a race with another write
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+PATCH_MAX_ATTEMPTS = int(os.getenv("PATCH_MAX_ATTEMPTS", "3"))
+
+# Dashboard reads are served from here; see cache.py for the backends
+expense_cache = make_cache()
+
+# Deferred work (leaderboard refresh, reconciliation, default months for new
+# users) runs here; see tasks.py for the backends
+task_queue = make_queue()
+metrics.collectors.append(task_queue.metric_lines)
+
+# Per-route rate and concurrency limits; see ratelimit.py
+limiter = make_limiter()
+metrics.collectors.append(limiter.metric_lines)
 
 class User(BaseModel):
     username: str
@@ -36,6 +196,92 @@ class Month(BaseModel):
 class Expense(BaseModel):
     months: list[Month]
 
+# One edit in a PATCH /expenses/{user_id} batch. Each op uses the fields of
+# the route it stands in for.
+OPERATION_FIELDS = {
+    "add_category": ("total_budget",),
+    "delete_category": (),
+    "modify_budget": ("new_budget",),
+    "add_subcategory": ("sub_category", "amount_spent"),
+    "update_subcategory": ("sub_category", "amount_spent"),
+    "delete_subcategory": ("sub_category",),
+}
+
+class ExpenseOperation(BaseModel):
+    op: Literal["add_category", "delete_category", "modify_budget",
+                "add_subcategory", "update_subcategory", "delete_subcategory"]
+    month: str
+    category: str
+    sub_category: Optional[str] = None
+    amount_spent: Optional[int] = None
+    total_budget: Optional[int] = None
+    new_budget: Optional[int] = None
+    sub_categories: list[SubCategory] = []
+
+    @model_validator(mode="after")
+    def check_fields(self):
+        missing = [name for name in OPERATION_FIELDS[self.op] if getattr(self, name) is None]
+        if missing:
+            raise ValueError(f"{self.op} needs {', '.join(missing)}")
+        return self
+
+class ExpensePatch(BaseModel):
+    operations: list[ExpenseOperation] = Field(min_length=1)
+
+# Response shapes of the read routes, for the OpenAPI docs only: those routes
+# return trusted Mongo output as a FastResponse, which FastAPI passes through
+# without validating. Fields are optional because ?fields= can drop them.
+class SubCategoryOut(BaseModel):
+    sub_category: str
+    amount_spent: int
+
+class CategoryOut(BaseModel):
+    category: str
+    total_budget: Optional[int] = None
+    amount_spent: Optional[int] = None
+    remaining_budget: Optional[int] = None
+    sub_categories: Optional[list[SubCategoryOut]] = None
+
+class MonthOut(BaseModel):
+    month: str
+    version: Optional[int] = None
+    monthly_budget: Optional[int] = None
+    amount_spent: Optional[int] = None
+    remaining_budget: Optional[int] = None
+    categories: Optional[list[CategoryOut]] = None
+
+class MonthWithComparisonOut(MonthOut):
+    comparison: Optional[MonthOut] = None
+
+class ExpenseOut(BaseModel):
+    id: str = Field(alias="_id")
+    version: Optional[int] = None
+    year: Optional[int] = None
+    since: Optional[int] = None
+    months: list[MonthOut]
+
+class SubCategoryPageOut(BaseModel):
+    month: str
+    version: int
+    category: str
+    total_budget: Optional[int] = None
+    amount_spent: Optional[int] = None
+    remaining_budget: Optional[int] = None
+    sub_categories: list[SubCategoryOut]
+    total_sub_categories: int
+    next_cursor: Optional[int] = None
+
+class LeaderboardEntryOut(BaseModel):
+    userid: str
+    total_savings: int
+
+# One line of a bulk upload
+class BulkExpenseRow(BaseModel):
+    month: str
+    category: str
+    sub_category: str
+    amount: int
+
 def convert_object_id(data):
     if isinstance(data, list):
         for item in data:
@@ -45,22 +291,15 @@ def convert_object_id(data):
         data['_id'] = str(data['_id'])
     return data
 
-from datetime import datetime
-
+def resolve_year(year):
+    return year if year is not None else datetime.now().year
 
-@router.post("/register")
-async def register_user(user: User, customer_details: CustomerDetails):
-    try:
-        if db.customer_details.find_one({"userid": customer_details.userid}):
-            raise HTTPException(status_code=400, detail="User already exists")
-        
-        db.customer_details.insert_one(customer_details.dict())
-
-        current_year = datetime.now().year
-        months = ['January', 'February', 'March', 'April', 'May', 'June', 
-                  'July', 'August', 'September', 'October', 'November', 'December']
-        
-        default_categories = [
+def default_month(month):
+    return with_totals({
+        "month": month,
+        "monthly_budget": 900,
+        "amount_spent": 0,
+        "categories": [
             {
                 "category": "Food",
                 "total_budget": 600,
@@ -72,20 +311,321 @@ async def register_user(user: User, customer_details: CustomerDetails):
                 "sub_categories": []
             }
         ]
+    })
 
-        expense_data = {
-            "_id": customer_details.userid,
-            "months": [
-                {
-                    "month": f"{month}",
-                    "monthly_budget": 900, 
-                    "amount_spent": 0,
-                    "categories": default_categories
-                } for month in months
-            ]
-        }
+# Running totals kept on every category and month: amount_spent and
+# remaining_budget. Writes maintain them with $inc deltas; these compute them
+# from scratch for new documents and for reconciliation.
+def category_with_totals(category):
+    category["amount_spent"] = sum(sub["amount_spent"] for sub in category["sub_categories"])
+    category["remaining_budget"] = category["total_budget"] - category["amount_spent"]
+    return category
+
+def with_totals(month):
+    for category in month["categories"]:
+        category_with_totals(category)
+    month["amount_spent"] = sum(category["amount_spent"] for category in month["categories"])
+    month["remaining_budget"] = month["monthly_budget"] - month["amount_spent"]
+    return month
+
+# Documents written before running totals existed have none; $inc on a missing
+# total would create it holding just the delta, so writes reconcile them instead
+def has_totals(month):
+    return "remaining_budget" in month and all("remaining_budget" in c for c in month["categories"])
+
+# Same computation as with_totals, as an aggregation expression over a month
+# ("$$m" for an element of months, "$$ROOT" for an expense_months document)
+def totals_expression(month):
+    categories = {"$map": {
+        "input": f"{month}.categories",
+        "as": "c",
+        "in": {"$mergeObjects": ["$$c", {
+            "amount_spent": {"$sum": "$$c.sub_categories.amount_spent"},
+            "remaining_budget": {"$subtract": ["$$c.total_budget", {"$sum": "$$c.sub_categories.amount_spent"}]},
+        }]}
+    }}
+    return {"$let": {"vars": {"categories": categories}, "in": {
+        "categories": "$$categories",
+        "amount_spent": {"$sum": "$$categories.amount_spent"},
+        "remaining_budget": {"$subtract": [f"{month}.monthly_budget", {"$sum": "$$categories.amount_spent"}]},
+    }}}
+
+# $inc document moving a category's and its month's totals by `spent`
+def spend_increments(scope, spent):
+    return {
+        f"{scope.prefix}amount_spent": spent,
+        f"{scope.prefix}remaining_budget": -spent,
+        f"{scope.prefix}categories.$[c].amount_spent": spent,
+        f"{scope.prefix}categories.$[c].remaining_budget": -spent,
+    }
+
+def find_category(month, category):
+    return next((c for c in month["categories"] if c["category"] == category), None)
+
+def month_doc_id(user_id, year, month):
+    return f"{user_id}:{year}:{month}"
+
+# Document stored in expense_months for one month of the embedded schema
+def month_document(user_id, year, month_data):
+    return {
+        "_id": month_doc_id(user_id, year, month_data["month"]),
+        "user_id": user_id,
+        "year": year,
+        "month_number": MONTHS.index(month_data["month"]) + 1,
+        **month_data,
+    }
+
+# Fields that only exist for storage and are stripped from API responses
+MONTH_DOC_FIELDS = {"_id": 0, "user_id": 0, "year": 0, "month_number": 0}
+
+def expense_collection(source=None):
+    source = source if source is not None else db
+    return source.expense_months if EXPENSE_STORAGE == "monthly" else source.expenses
+
+# Where a read route reads from: read_db (MONGO_READ_PREFERENCE), unless the
+# result is going into expense_cache. A lagging secondary read cached right
+# after a write's invalidation would be served for the whole cache TTL.
+def read_source(cached=False):
+    return db if cached and expense_cache.backend != "none" else read_db
+
+# Whether a read came back older than min_version, a version the client has
+# already seen (e.g. in the response to its own write). Such a read from a
+# lagging secondary is repeated on the primary, and such a cached copy (from
+# another worker's in-process cache, or cached before the write) is a miss,
+# so neither MONGO_READ_PREFERENCE nor the cache breaks read-your-writes.
+def behind(doc, min_version):
+    return min_version is not None and (doc.get("version") or 0) < min_version
 
-        db.expenses.insert_one(expense_data)
+class MonthScope(NamedTuple):
+    collection: object
+    filter: dict
+    prefix: str
+    array_filters: list
+    projection: Optional[dict]
+
+# Where one month of a user's expenses lives for the configured storage mode.
+# The filter only matches if the month exists and satisfies `conditions`;
+# prefix is prepended to field paths inside the month in update documents.
+def month_scope(user_id, month, year=None, conditions=None):
+    if EXPENSE_STORAGE == "monthly":
+        return MonthScope(
+            db.expense_months,
+            {"_id": month_doc_id(user_id, resolve_year(year), month), **(conditions or {})},
+            "",
+            [],
+            MONTH_DOC_FIELDS,
+        )
+    return MonthScope(
+        db.expenses,
+        {"_id": user_id, "months": {"$elemMatch": {"month": month, **(conditions or {})}}},
+        "months.$[m].",
+        [{"m.month": month}],
+        {"months": {"$elemMatch": {"month": month}}},
+    )
+
+# Pull the month out of a document fetched with MonthScope.projection
+def month_from(doc):
+    return doc["months"][0] if "months" in doc else doc
+
+# Fetch just one month, raising the same 404s the routes always have
+async def find_month(user_id, month, year=None):
+    scope = month_scope(user_id, month, year)
+    query = scope.filter if EXPENSE_STORAGE == "monthly" else {"_id": user_id}
+    doc = await scope.collection.find_one(query, scope.projection)
+    if not doc and month in MONTHS and await create_default_expense(user_id, year):
+        doc = await scope.collection.find_one(query, scope.projection)
+    if EXPENSE_STORAGE == "monthly":
+        if not doc:
+            await raise_not_found(user_id, "Month not found.")
+        return doc
+
+    if not doc:
+        raise HTTPException(status_code=404, detail="Expense not found.")
+    if not doc.get("months"):
+        raise HTTPException(status_code=404, detail="Month not found.")
+    return month_from(doc)
+
+# Fields a client may ask for with ?fields=, relative to a month
+MONTH_FIELDS = {"month", "monthly_budget", "amount_spent", "remaining_budget", "version", "categories"}
+CATEGORY_FIELDS = {"category", "total_budget", "amount_spent", "remaining_budget", "sub_categories"}
+# What a comparison month returns unless asked for more
+COMPARISON_FIELDS = "month,monthly_budget,amount_spent,remaining_budget"
+
+# Parse "amount_spent,categories.category" into an inclusion projection for a
+# month. month and version are always kept so responses stay mergeable and
+# ETags keep working.
+def month_fields(fields):
+    projection = {"month": 1, "version": 1}
+    for field in filter(None, (f.strip() for f in fields.split(","))):
+        head, _, rest = field.partition(".")
+        if head not in MONTH_FIELDS or (rest and (head != "categories" or rest not in CATEGORY_FIELDS)):
+            raise HTTPException(status_code=400, detail=f"Unknown field: {field}")
+        projection[field] = 1
+    # A parent path and one of its children can't both be projected
+    if "categories" in projection:
+        projection = {f: 1 for f in projection if not f.startswith("categories.")}
+    return projection
+
+# Aggregation stages narrowing a user's expenses to one month document, so
+# projections and slices inside it run on the server in both storage modes.
+# find() can't combine a months.$elemMatch with sub-field projections.
+def month_pipeline(user_id, month, year=None):
+    if EXPENSE_STORAGE == "monthly":
+        return [{"$match": {"_id": month_doc_id(user_id, resolve_year(year), month)}}]
+    return [
+        {"$match": {"_id": user_id, "months.month": month}},
+        {"$replaceRoot": {"newRoot": {"$arrayElemAt": [
+            {"$filter": {"input": "$months", "as": "m", "cond": {"$eq": ["$$m.month", month]}}}, 0
+        ]}}},
+    ]
+
+# Run `stages` over one month (see month_pipeline), creating the default
+# months first if the user has none yet
+async def aggregate_month(user_id, month, year, stages, source=None):
+    pipeline = month_pipeline(user_id, month, year) + stages
+    docs = await (await expense_collection(source).aggregate(pipeline)).to_list(1)
+    # Months just created are only certain to be on the primary
+    if not docs and month in MONTHS and await create_default_expense(user_id, year):
+        docs = await (await expense_collection().aggregate(pipeline)).to_list(1)
+    if not docs:
+        await raise_not_found(user_id, "Month not found.")
+    return docs[0]
+
+# One month with only the projected fields
+async def find_month_fields(user_id, month, year=None, fields=COMPARISON_FIELDS, source=None):
+    return await aggregate_month(user_id, month, year, [{"$project": {"_id": 0, **month_fields(fields)}}], source)
+
+# Whole-year expense document in the embedded shape, whichever storage is used.
+# With `fields`, every month is cut down to that projection on the server.
+async def load_expense(user_id, year=None, fields=None, source=None):
+    source = source if source is not None else db
+    projection = month_fields(fields) if fields else None
+    if EXPENSE_STORAGE == "monthly":
+        year = resolve_year(year)
+        months = await source.expense_months.find(
+            {"user_id": user_id, "year": year},
+            {"_id": 0, **projection} if projection else MONTH_DOC_FIELDS,
+        ).sort("month_number", ASCENDING).to_list(None)
+        if not months:
+            return None
+        # Every bump stamps at least one month, so the newest month is the year's version
+        return {"_id": user_id, "year": year, "version": max(m.get("version", 0) for m in months), "months": months}
+    if projection:
+        return await source.expenses.find_one({"_id": user_id}, {"version": 1, **{f"months.{f}": 1 for f in projection}})
+    return await source.expenses.find_one({"_id": user_id})
+
+# Increment the user's version and stamp it on the months that changed, so
+# clients can revalidate with ETags and ask for ?since=<version> deltas
+async def bump_version(user_id, months, year=None):
+    if EXPENSE_STORAGE == "monthly":
+        year = resolve_year(year)
+        counter = await db.expense_versions.find_one_and_update(
+            {"_id": f"{user_id}:{year}"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        await db.expense_months.update_many(
+            {"_id": {"$in": [month_doc_id(user_id, year, month) for month in months]}},
+            {"$max": {"version": counter["version"]}},
+        )
+        return counter["version"]
+
+    # One pipeline update: the second stage already sees the incremented version
+    expense = await db.expenses.find_one_and_update(
+        {"_id": user_id},
+        [
+            {"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}},
+            {"$set": {"months": {"$map": {
+                "input": "$months",
+                "as": "m",
+                "in": {"$cond": [
+                    {"$in": ["$$m.month", list(months)]},
+                    {"$mergeObjects": ["$$m", {"version": "$version"}]},
+                    "$$m"
+                ]}
+            }}}},
+        ],
+        projection={"version": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    return expense["version"] if expense else None
+
+def etag(version):
+    return f'"{version or 0}"'
+
+def not_modified(if_none_match, tag):
+    return if_none_match is not None and tag in [t.strip() for t in if_none_match.split(",")]
+
+# Cache key for a user's whole year (month=None) or a single month. Embedded
+# storage has no year, so every ?year= maps to the same entry there.
+def cache_key(user_id, month=None, year=None):
+    year_key = resolve_year(year) if EXPENSE_STORAGE == "monthly" else "all"
+    return f"{user_id}:{year_key}:{month or '*'}"
+
+# Every write goes through here so derived data (cache, leaderboard) follows it.
+# The leaderboard catches up in the background. bump=False is for writes that
+# already stamped the new version themselves.
+async def expense_changed(user_id, months=MONTHS, year=None, bump=True):
+    if bump:
+        await bump_version(user_id, months, year)
+    if ANALYTICS_SNAPSHOT:
+        await db.analytics_dirty.update_one({"_id": user_id}, {"$set": {"changed_at": datetime.utcnow()}}, upsert=True)
+    await expense_cache.delete(cache_key(user_id, year=year), *(cache_key(user_id, month, year) for month in months))
+    if MATERIALIZE_LEADERBOARD:
+        await task_queue.enqueue("refresh_leaderboard", user_id, list(months), year)
+
+async def save_expense(user_id, months, year=None, insert=False):
+    months = [with_totals(m) for m in months]
+    if EXPENSE_STORAGE == "monthly":
+        year = resolve_year(year)
+        docs = [month_document(user_id, year, m) for m in months]
+        if insert:
+            await db.expense_months.insert_many(docs)
+        else:
+            await db.expense_months.bulk_write([ReplaceOne({"_id": d["_id"]}, d, upsert=True) for d in docs])
+    elif insert:
+        await db.expenses.insert_one({"_id": user_id, "months": months})
+    else:
+        await db.expenses.update_one({"_id": user_id}, {"$set": {"months": months}})
+
+# Give a registered user the default months if they have none (for the year,
+# in monthly storage). Runs as a job after registration and again on a read
+# that finds nothing, e.g. the first read of a new year; the upserts make the
+# two safe to race. Returns whether anything was created.
+@job
+async def create_default_expense(user_id, year=None):
+    if not await db.customer_details.count_documents({"userid": user_id}, limit=1):
+        return False
+    months = [default_month(month) for month in MONTHS]
+    if EXPENSE_STORAGE == "monthly":
+        year = resolve_year(year)
+        docs = [month_document(user_id, year, m) for m in months]
+        result = await db.expense_months.bulk_write([
+            UpdateOne({"_id": d["_id"]}, {"$setOnInsert": {k: v for k, v in d.items() if k != "_id"}}, upsert=True)
+            for d in docs
+        ])
+        created = result.upserted_count > 0
+    else:
+        result = await db.expenses.update_one({"_id": user_id}, {"$setOnInsert": {"months": months}}, upsert=True)
+        created = result.upserted_id is not None
+    if created:
+        await expense_changed(user_id, year=year)
+    return created
+
+
+@router.post("/register")
+async def register_user(user: User, customer_details: CustomerDetails):
+    try:
+        # The unique index on userid is the duplicate check
+        details = customer_details.dict()
+        details["password"] = await auth.hash_password_async(customer_details.password)
+        try:
+            await db.customer_details.insert_one(details)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=400, detail="User already exists")
+
+        await task_queue.enqueue("create_default_expense", customer_details.userid)
 
         return {"message": "User registered successfully"}
     except Exception as e:
@@ -93,40 +633,59 @@ async def register_user(user: User, customer_details: CustomerDetails):
 
 # New endpoint to modify budget
 @router.put("/expenses/{user_id}/modify-budget")
-async def modify_budget(user_id: str, month: str, category: str, new_budget: int):
+async def modify_budget(user_id: str, month: str, category: str, new_budget: int, year: Optional[int] = None):
     try:
-        expense = db.expenses.find_one({"_id": user_id})
-        if not expense:
-            raise HTTPException(status_code=404, detail="Expense not found.")
+        # Swap the category budget in place and read back only its old value
+        scope = month_scope(user_id, month, year, {"categories.category": category})
+        before = await scope.collection.find_one_and_update(
+            scope.filter,
+            {"$set": {f"{scope.prefix}categories.$[c].total_budget": new_budget}},
+            projection=scope.projection,
+            array_filters=scope.array_filters + [{"c.category": category}],
+        )
+        if not before:
+            await raise_not_found(user_id, "Month or category not found.")
+
+        old_month = month_from(before)
+        delta = new_budget - find_category(old_month, category)["total_budget"]
+
+        # Update monthly budget and both remaining budgets by the difference
+        increments = {f"{scope.prefix}monthly_budget": delta}
+        if has_totals(old_month):
+            increments[f"{scope.prefix}remaining_budget"] = delta
+            increments[f"{scope.prefix}categories.$[c].remaining_budget"] = delta
+        await scope.collection.update_one(
+            scope.filter,
+            {"$inc": increments},
+            array_filters=scope.array_filters + [{"c.category": category}],
+        )
+        if not has_totals(old_month):
+            await reconcile_totals(user_id)
+        await expense_changed(user_id, [month], year)
+        return {"message": f"Budget for {category} updated successfully. Monthly budget adjusted."}
 
-        for m in expense["months"]:
-            if m["month"] == month:
-                for c in m["categories"]:
-                    if c["category"] == category:
-                        old_budget = c["total_budget"]
-                        c["total_budget"] = new_budget
-                        
-                        # Update monthly budget
-                        m["monthly_budget"] += (new_budget - old_budget)
-                        
-                        db.expenses.update_one({"_id": user_id}, {"$set": {"months": expense["months"]}})
-                        return {"message": f"Budget for {category} updated successfully. Monthly budget adjusted."}
-                
-                raise HTTPException(status_code=404, detail="Category not found.")
-        
-        raise HTTPException(status_code=404, detail="Month not found.")
-    
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-# API Endpoint for user authentication
+# API Endpoint for user authentication. The token it returns is sent back as
+# "Authorization: Bearer <token>"; see require_session.
 @router.post("/login")
 async def login_user(customer_details: CustomerDetails):
     try:
-        user = db.customer_details.find_one({"userid": customer_details.userid, "password": customer_details.password})
-        if user:
-            return {"message": "Login successful"}
+        user = await db.customer_details.find_one({"userid": customer_details.userid}, {"password": 1})
+        if user and await auth.check_credentials(customer_details.userid, customer_details.password, user["password"]):
+            # Plaintext rows from before hashing, or hashes with old cost parameters
+            if auth.needs_rehash(user["password"]):
+                await db.customer_details.update_one(
+                    {"_id": user["_id"], "password": user["password"]},
+                    {"$set": {"password": await auth.hash_password_async(customer_details.password)}},
+                )
+            return {
+                "message": "Login successful",
+                "token": auth.issue_token(customer_details.userid),
+                "expires_in": auth.SESSION_TTL_SECONDS,
+            }
         else:
             raise HTTPException(status_code=401, detail="Invalid credentials")
     except Exception as e:
@@ -134,45 +693,143 @@ async def login_user(customer_details: CustomerDetails):
 
 # Create new user with initial expense data
 @router.post("/expenses/{user_id}")
-async def create_expense(user_id: str, expense: Expense):
+async def create_expense(user_id: str, expense: Expense, year: Optional[int] = None):
     try:
-        db.expenses.insert_one({"_id": user_id, **expense.dict()})
+        await save_expense(user_id, expense.dict()["months"], year, insert=True)
+        await expense_changed(user_id, year=year)
         return {"message": "Expense created successfully."}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-# Read entire expense for a user
-@router.get("/expenses/{user_id}")
-async def read_expense(user_id: str):
+# Only the months stamped after the client's copy at version `since`
+def expense_delta(expense, since):
+    return {
+        "_id": expense["_id"],
+        "version": expense.get("version", 0),
+        "since": since,
+        "months": [m for m in expense["months"] if m.get("version", 0) > since],
+    }
+
+# Read entire expense for a user. ?fields= cuts every month down to the
+# listed fields (e.g. month,amount_spent) on the server.
+@router.get("/expenses/{user_id}", response_model=ExpenseOut)
+async def read_expense(user_id: str, year: Optional[int] = None, since: Optional[int] = None,
+                       fields: Optional[str] = None, min_version: Optional[int] = None,
+                       if_none_match: Optional[str] = Header(None)):
     try:
-        expense = db.expenses.find_one({"_id": user_id})
-        if expense:
-            return convert_object_id(expense)
-        else:
-            raise HTTPException(status_code=404, detail="Expense not found.")
+        # Projected reads are small and skip the cache, which holds whole documents
+        key = cache_key(user_id, year=year)
+        expense = None if fields else await expense_cache.get(key)
+        if expense is None or behind(expense, min_version):
+            # Taken before the load, so a write invalidating the key meanwhile
+            # keeps this possibly older copy out of the cache
+            generation = None if fields else await expense_cache.generation(key)
+            expense = await load_expense(user_id, year, fields, read_source(cached=not fields))
+            if expense and behind(expense, min_version):
+                expense = await load_expense(user_id, year, fields)
+            if not expense and await create_default_expense(user_id, year):
+                expense = await load_expense(user_id, year, fields)
+            if not expense:
+                raise HTTPException(status_code=404, detail="Expense not found.")
+            expense = convert_object_id(expense)
+            if not fields:
+                await expense_cache.set(key, expense, generation)
+
+        tag = etag(expense.get("version"))
+        if not_modified(if_none_match, tag):
+            return Response(status_code=304, headers={"ETag": tag})
+        return FastResponse(expense_delta(expense, since) if since is not None else expense, headers={"ETag": tag})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-# Read expense for a specific month for a user
-@router.get("/expenses/{user_id}/month/{month}")
-async def read_month_expense(user_id: str, month: str):
+# Read expense for a specific month for a user. ?fields= projects the month,
+# ?compare=<month> adds that month's totals under "comparison". min_version and
+# compare_min_version are the month versions the client already knows of.
+@router.get("/expenses/{user_id}/month/{month}", response_model=MonthWithComparisonOut)
+async def read_month_expense(user_id: str, month: str, year: Optional[int] = None,
+                             fields: Optional[str] = None, compare: Optional[str] = None,
+                             compare_fields: str = COMPARISON_FIELDS, min_version: Optional[int] = None,
+                             compare_min_version: Optional[int] = None, if_none_match: Optional[str] = Header(None)):
     try:
-        expense = db.expenses.find_one({"_id": user_id})
-        if expense:
-            for m in expense["months"]:
-                if m["month"] == month:
-                    return m
-            raise HTTPException(status_code=404, detail="Month not found.")
+        if fields:
+            month_data = await find_month_fields(user_id, month, year, fields, read_source())
+            if behind(month_data, min_version):
+                month_data = await find_month_fields(user_id, month, year, fields)
         else:
-            raise HTTPException(status_code=404, detail="Expense not found.")
+            key = cache_key(user_id, month, year)
+            month_data = await expense_cache.get(key)
+            if month_data is None or behind(month_data, min_version):
+                generation = await expense_cache.generation(key)
+                month_data = await find_month(user_id, month, year)
+                await expense_cache.set(key, month_data, generation)
+
+        tag = etag(month_data.get("version"))
+        comparison = None
+        if compare:
+            comparison = await find_month_fields(user_id, compare, year, compare_fields, read_source())
+            if behind(comparison, compare_min_version):
+                comparison = await find_month_fields(user_id, compare, year, compare_fields)
+            tag = etag(f"{month_data.get('version') or 0}.{comparison.get('version') or 0}")
+
+        if not_modified(if_none_match, tag):
+            return Response(status_code=304, headers={"ETag": tag})
+        return FastResponse({**month_data, "comparison": comparison} if compare else month_data, headers={"ETag": tag})
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Page through one category's sub-categories; the array is sliced on the
+# server. cursor is the next_cursor of the previous page (an offset, so a
+# delete between pages shifts later items back by one).
+@router.get("/expenses/{user_id}/month/{month}/category/{category}/subcategories", response_model=SubCategoryPageOut)
+async def read_subcategories(user_id: str, month: str, category: str,
+                             limit: int = Query(50, ge=1, le=500), cursor: int = Query(0, ge=0),
+                             year: Optional[int] = None, min_version: Optional[int] = None,
+                             if_none_match: Optional[str] = Header(None)):
+    try:
+        stages = [{"$project": {
+            "_id": 0,
+            "month": 1,
+            "version": 1,
+            "category": {"$let": {
+                "vars": {"c": {"$arrayElemAt": [
+                    {"$filter": {"input": "$categories", "as": "c", "cond": {"$eq": ["$$c.category", category]}}}, 0
+                ]}},
+                "in": {
+                    "category": "$$c.category",
+                    "total_budget": "$$c.total_budget",
+                    "amount_spent": "$$c.amount_spent",
+                    "remaining_budget": "$$c.remaining_budget",
+                    "count": {"$size": {"$ifNull": ["$$c.sub_categories", []]}},
+                    "sub_categories": {"$slice": [{"$ifNull": ["$$c.sub_categories", []]}, cursor, limit]},
+                },
+            }},
+        }}]
+        page = await aggregate_month(user_id, month, year, stages, read_source())
+        if behind(page, min_version):
+            page = await aggregate_month(user_id, month, year, stages)
+        if not page.get("category", {}).get("category"):
+            raise HTTPException(status_code=404, detail="Category not found.")
+
+        tag = etag(page.get("version"))
+        if not_modified(if_none_match, tag):
+            return Response(status_code=304, headers={"ETag": tag})
+        count = page["category"].pop("count")
+        return FastResponse({
+            "month": page["month"],
+            "version": page.get("version", 0),
+            **page["category"],
+            "total_sub_categories": count,
+            "next_cursor": cursor + limit if cursor + limit < count else None,
+        }, headers={"ETag": tag})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Update user expense
 @router.put("/expenses/{user_id}")
-async def update_expense(user_id: str, expense: Expense):
+async def update_expense(user_id: str, expense: Expense, year: Optional[int] = None):
     try:
-        db.expenses.update_one({"_id": user_id}, {"$set": expense.dict()})
+        await save_expense(user_id, expense.dict()["months"], year)
+        await expense_changed(user_id, year=year)
         return {"message": "Expense updated successfully."}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -180,146 +837,1100 @@ async def update_expense(user_id: str, expense: Expense):
 
 # Update subcategory
 @router.put("/expenses/{user_id}/month/{month}/category/{category}/subcategory/{sub_category}")
-async def update_subcategory(user_id: str, month: str, category: str, sub_category: str, amount_spent: int):
+async def update_subcategory(user_id: str, month: str, category: str, sub_category: str, amount_spent: int, year: Optional[int] = None):
     try:
-        expense = db.expenses.find_one({"_id": user_id})
-        if expense:
-            for m in expense["months"]:
-                if m["month"] == month:
-                    for c in m["categories"]:
-                        if c["category"] == category:
-                            for sc in c["sub_categories"]:
-                                if sc["sub_category"] == sub_category:
-                                    sc["amount_spent"] = amount_spent
-                                    db.expenses.update_one({"_id": user_id}, {"$set": {"months": expense["months"]}})
-                                    return {"message": "Subcategory updated successfully."}
-            raise HTTPException(status_code=404, detail="Month, category, or subcategory not found.")
-        else:
-            raise HTTPException(status_code=404, detail="Expense not found.")
+        scope = month_scope(user_id, month, year, {"categories": {"$elemMatch": {"category": category, "sub_categories.sub_category": sub_category}}})
+        before = await scope.collection.find_one_and_update(
+            scope.filter,
+            {"$set": {f"{scope.prefix}categories.$[c].sub_categories.$[s].amount_spent": amount_spent}},
+            projection=scope.projection,
+            array_filters=scope.array_filters + [{"c.category": category}, {"s.sub_category": sub_category}],
+        )
+        if not before:
+            await raise_not_found(user_id, "Month, category, or subcategory not found.")
+
+        # Every sub-category with this name was set, so apply the summed difference
+        old_amounts = [sc["amount_spent"] for sc in find_category(month_from(before), category)["sub_categories"]
+                       if sc["sub_category"] == sub_category]
+        await apply_spend(user_id, scope, category, amount_spent * len(old_amounts) - sum(old_amounts), month_from(before))
+        await expense_changed(user_id, [month], year)
+        return {"message": "Subcategory updated successfully."}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-from fastapi import FastAPI, APIRouter, HTTPException
-from pydantic import BaseModel
-from pymongo import MongoClient
-from bson import ObjectId
-
+# Only called once an update matched nothing, to pick the right 404 message
+async def raise_not_found(user_id, detail):
+    if EXPENSE_STORAGE == "monthly":
+        exists = await db.expense_months.count_documents({"user_id": user_id}, limit=1)
+    else:
+        exists = await db.expenses.count_documents({"_id": user_id}, limit=1)
+    if not exists:
+        raise HTTPException(status_code=404, detail="Expense not found.")
+    raise HTTPException(status_code=404, detail=detail)
 
-# Add this function to calculate total spent
-def calculate_total_spent(categories):
-    return sum(
-        subcategory['amount_spent']
-        for category in categories
-        for subcategory in category.get('sub_categories', [])
-    )
+# Move the totals by what a write that read `old_month` changed
+async def apply_spend(user_id, scope, category, spent, old_month):
+    if not has_totals(old_month):
+        await reconcile_totals(user_id)
+    elif spent:
+        await scope.collection.update_one(
+            {"_id": scope.filter["_id"]},
+            {"$inc": spend_increments(scope, spent)},
+            array_filters=scope.array_filters + [{"c.category": category}],
+        )
 
 # Modify your add_subcategory route
 @router.post("/expenses/{user_id}/month/{month}/category/{category}")
-async def add_subcategory(user_id: str, month: str, category: str, subcategory: SubCategory):
+async def add_subcategory(user_id: str, month: str, category: str, subcategory: SubCategory, year: Optional[int] = None):
     try:
-        expense = db.expenses.find_one({"_id": user_id})
-        if not expense:
-            raise HTTPException(status_code=404, detail="Expense not found.")
+        # The remaining-budget check is part of the filter, so the check and the
+        # write are one atomic step; only a rejected write costs a read
+        for attempt in range(2):
+            scope = month_scope(user_id, month, year, {"categories": {"$elemMatch": {
+                "category": category,
+                "remaining_budget": {"$gte": subcategory.amount_spent},
+            }}})
+            result = await scope.collection.update_one(
+                scope.filter,
+                {
+                    "$push": {f"{scope.prefix}categories.$[c].sub_categories": subcategory.dict()},
+                    "$inc": spend_increments(scope, subcategory.amount_spent),
+                },
+                array_filters=scope.array_filters + [{"c.category": category}],
+            )
+            if result.matched_count:
+                break
 
-        for m in expense["months"]:
-            if m["month"] == month:
-                for c in m["categories"]:
-                    if c["category"] == category:
-                        current_spent = sum(sub['amount_spent'] for sub in c["sub_categories"])
-                        remaining_budget = c["total_budget"] - current_spent
-                        if subcategory.amount_spent > remaining_budget:
-                            raise HTTPException(status_code=400, detail=f"Expense exceeds remaining budget. Remaining budget: ${remaining_budget}")
-                        
-                        c["sub_categories"].append(subcategory.dict())
-                        m["amount_spent"] = calculate_total_spent(m["categories"])
-                        db.expenses.update_one({"_id": user_id}, {"$set": {"months": expense["months"]}})
-                        return {"message": "Subcategory added successfully and total amount updated."}
-                
+            c = find_category(await find_month(user_id, month, year), category)
+            if c is None:
                 raise HTTPException(status_code=404, detail="Category not found.")
-        
-        raise HTTPException(status_code=404, detail="Month not found.")
-    
+            remaining_budget = c.get("remaining_budget", c["total_budget"] - sum(sub['amount_spent'] for sub in c["sub_categories"]))
+            if attempt or ("remaining_budget" in c and remaining_budget < subcategory.amount_spent):
+                raise HTTPException(status_code=400, detail=f"Expense exceeds remaining budget. Remaining budget: ${remaining_budget}")
+            if "remaining_budget" not in c:
+                # Written before running totals existed: compute them once and retry
+                await reconcile_totals(user_id)
+            # Otherwise the expense fits, so the update missed because find_month
+            # only just created the months (e.g. the job creating a new user's
+            # is still queued, or it's the first write of a year): retry
+
+        await expense_changed(user_id, [month], year)
+        return {"message": "Subcategory added successfully and total amount updated."}
+
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    
+
 # Similarly, update the delete_subcategory route
 @router.delete("/expenses/{user_id}/month/{month}/category/{category}/subcategory/{sub_category}")
-async def delete_subcategory(user_id: str, month: str, category: str, sub_category: str):
+async def delete_subcategory(user_id: str, month: str, category: str, sub_category: str, year: Optional[int] = None):
     try:
-        expense = db.expenses.find_one({"_id": user_id})
-        if expense:
-            for m in expense["months"]:
-                if m["month"] == month:
-                    for c in m["categories"]:
-                        if c["category"] == category:
-                            c["sub_categories"] = [sc for sc in c["sub_categories"] if sc["sub_category"] != sub_category]
-                            
-                            # Recalculate the total amount spent for the month
-                            m["amount_spent"] = calculate_total_spent(m["categories"])
-                            
-                            db.expenses.update_one({"_id": user_id}, {"$set": {"months": expense["months"]}})
-                            return {"message": "Subcategory deleted successfully and total amount updated."}
-            raise HTTPException(status_code=404, detail="Month, category, or subcategory not found.")
-        else:
-            raise HTTPException(status_code=404, detail="Expense not found.")
+        scope = month_scope(user_id, month, year, {"categories.category": category})
+        before = await scope.collection.find_one_and_update(
+            scope.filter,
+            {"$pull": {f"{scope.prefix}categories.$[c].sub_categories": {"sub_category": sub_category}}},
+            projection=scope.projection,
+            array_filters=scope.array_filters + [{"c.category": category}],
+        )
+        if not before:
+            await raise_not_found(user_id, "Month, category, or subcategory not found.")
+
+        # Take what was removed off the category and month totals
+        removed = sum(sc["amount_spent"] for sc in find_category(month_from(before), category)["sub_categories"]
+                      if sc["sub_category"] == sub_category)
+        await apply_spend(user_id, scope, category, -removed, month_from(before))
+        await expense_changed(user_id, [month], year)
+        return {"message": "Subcategory deleted successfully and total amount updated."}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Update the add_category route to initialize amount_spent
 @router.post("/expenses/{user_id}/month/{month}")
-async def add_category(user_id: str, month: str, category: Category):
+async def add_category(user_id: str, month: str, category: Category, year: Optional[int] = None):
     try:
-        expense = db.expenses.find_one({"_id": user_id})
-        if expense:
-            for m in expense["months"]:
-                if m["month"] == month:
-                    m["categories"].append(category.dict())
-                    # Recalculate the total amount spent for the month
-                    m["amount_spent"] = calculate_total_spent(m["categories"])
-                    db.expenses.update_one({"_id": user_id}, {"$set": {"months": expense["months"]}})
-                    return {"message": "Category added successfully and total amount updated."}
-            raise HTTPException(status_code=404, detail="Month not found.")
-        else:
-            raise HTTPException(status_code=404, detail="Expense not found.")
+        new_category = category_with_totals(category.dict())
+        # Only a month that already has totals is matched; one from before them
+        # is reconciled first
+        for attempt in range(2):
+            scope = month_scope(user_id, month, year, {"remaining_budget": {"$exists": True}})
+            result = await scope.collection.update_one(
+                scope.filter,
+                {
+                    "$push": {f"{scope.prefix}categories": new_category},
+                    "$inc": {
+                        f"{scope.prefix}amount_spent": new_category["amount_spent"],
+                        f"{scope.prefix}remaining_budget": -new_category["amount_spent"],
+                    },
+                },
+                array_filters=scope.array_filters or None,
+            )
+            if result.matched_count:
+                break
+            if attempt or not await reconcile_totals(user_id):
+                await raise_not_found(user_id, "Month not found.")
+
+        await expense_changed(user_id, [month], year)
+        return {"message": "Category added successfully and total amount updated."}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Update the delete_category route
 @router.delete("/expenses/{user_id}/month/{month}/category/{category}")
-async def delete_category(user_id: str, month: str, category: str):
+async def delete_category(user_id: str, month: str, category: str, year: Optional[int] = None):
     try:
-        expense = db.expenses.find_one({"_id": user_id})
-        if expense:
-            for m in expense["months"]:
-                if m["month"] == month:
-                    m["categories"] = [c for c in m["categories"] if c["category"] != category]
-                    # Recalculate the total amount spent for the month
-                    m["amount_spent"] = calculate_total_spent(m["categories"])
-                    db.expenses.update_one({"_id": user_id}, {"$set": {"months": expense["months"]}})
-                    return {"message": "Category deleted successfully and total amount updated."}
-            raise HTTPException(status_code=404, detail="Month or category not found.")
+        scope = month_scope(user_id, month, year)
+        before = await scope.collection.find_one_and_update(
+            scope.filter,
+            {"$pull": {f"{scope.prefix}categories": {"category": category}}},
+            projection=scope.projection,
+            array_filters=scope.array_filters or None,
+        )
+        if not before:
+            await raise_not_found(user_id, "Month or category not found.")
+
+        # The category is gone, so only the month totals move ($[c] matches nothing)
+        removed = sum(sc["amount_spent"] for c in month_from(before)["categories"] if c["category"] == category
+                      for sc in c["sub_categories"])
+        await apply_spend(user_id, scope, category, -removed, month_from(before))
+        await expense_changed(user_id, [month], year)
+        return {"message": "Category deleted successfully and total amount updated."}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Apply a batch's operations in order to `months` (month name -> month, edited
+# in place), with the same rules as the single-edit routes. Raises on the first
+# invalid one, before anything has been written.
+def apply_operations(months, operations):
+    for index, op in enumerate(operations):
+        def fail(status_code, detail):
+            raise HTTPException(status_code=status_code, detail=f"operations[{index}] ({op.op}): {detail}")
+
+        month = months.get(op.month)
+        if month is None:
+            fail(404, "Month not found.")
+        if op.op == "add_category":
+            month["categories"].append(category_with_totals({
+                "category": op.category,
+                "total_budget": op.total_budget,
+                "sub_categories": [sub.dict() for sub in op.sub_categories],
+            }))
+            continue
+        if op.op == "delete_category":
+            month["categories"] = [c for c in month["categories"] if c["category"] != op.category]
+            continue
+
+        category = find_category(month, op.category)
+        if category is None:
+            fail(404, "Category not found.")
+        if op.op == "modify_budget":
+            month["monthly_budget"] += op.new_budget - category["total_budget"]
+            category["total_budget"] = op.new_budget
+        elif op.op == "add_subcategory":
+            remaining_budget = category_with_totals(category)["remaining_budget"]
+            if op.amount_spent > remaining_budget:
+                fail(400, f"Expense exceeds remaining budget. Remaining budget: ${remaining_budget}")
+            category["sub_categories"].append({"sub_category": op.sub_category, "amount_spent": op.amount_spent})
+        elif op.op == "update_subcategory":
+            matches = [sub for sub in category["sub_categories"] if sub["sub_category"] == op.sub_category]
+            if not matches:
+                fail(404, "Subcategory not found.")
+            for sub in matches:
+                sub["amount_spent"] = op.amount_spent
         else:
+            category["sub_categories"] = [sub for sub in category["sub_categories"] if sub["sub_category"] != op.sub_category]
+    for month in months.values():
+        with_totals(month)
+
+def check_if_match(if_match, version):
+    # Same tag-list matching as If-None-Match
+    if if_match is not None and if_match.strip() != "*" and not not_modified(if_match, etag(version)):
+        raise HTTPException(status_code=412, detail="Expense has changed since it was read.",
+                            headers={"ETag": etag(version)})
+
+# Embedded storage: one read of only the touched months and the month names,
+# then one update that also stamps the new version. It is guarded by the
+# version that was read and by each touched month still being exactly as read:
+# the single-edit routes change a month before bumping the version, so the
+# version alone would let this overwrite their line items. Losing a race means
+# re-reading and applying again (or 412 under If-Match).
+async def patch_embedded(user_id, months, operations, if_match):
+    pipeline = [
+        {"$match": {"_id": user_id}},
+        {"$project": {
+            "version": 1,
+            "months": {"$filter": {"input": "$months", "as": "m", "cond": {"$in": ["$$m.month", months]}}},
+            "names": "$months.month",
+        }},
+    ]
+    for attempt in range(PATCH_MAX_ATTEMPTS):
+        docs = await (await db.expenses.aggregate(pipeline)).to_list(1)
+        if not docs:
             raise HTTPException(status_code=404, detail="Expense not found.")
+        expense = docs[0]
+        check_if_match(if_match, expense.get("version", 0))
+
+        positions = {name: i for i, name in enumerate(expense.get("names", []))}
+        read = {m["month"]: m for m in expense["months"]}
+        # Guard with the months as read; apply_operations edits copies of them
+        query = {"_id": user_id, "version": expense.get("version"),
+                 **{f"months.{positions[name]}": month for name, month in read.items()}}
+        touched = {name: copy.deepcopy(month) for name, month in read.items()}
+        apply_operations(touched, operations)
+
+        version = expense.get("version", 0) + 1
+        update = {"version": version}
+        for name, month in touched.items():
+            month["version"] = version
+            update[f"months.{positions[name]}"] = month
+        # {"version": None} also matches a document that was never versioned
+        result = await db.expenses.update_one(query, {"$set": update})
+        if result.matched_count:
+            return version
+    raise HTTPException(status_code=409, detail="Expense is being changed concurrently; try again.")
+
+# Monthly storage, one month: a single document, so no transaction (which a
+# standalone mongod doesn't support). It is replaced only if still exactly as
+# read, then the version is bumped like any single edit. Losing a race means
+# re-reading and applying again (or 412 under If-Match).
+async def patch_month(user_id, month, operations, if_match, year):
+    doc_id = month_doc_id(user_id, year, month)
+    for attempt in range(PATCH_MAX_ATTEMPTS):
+        counter = await db.expense_versions.find_one({"_id": f"{user_id}:{year}"})
+        check_if_match(if_match, counter["version"] if counter else 0)
+
+        doc = await db.expense_months.find_one({"_id": doc_id})
+        if not doc:
+            await raise_not_found(user_id, "Month not found.")
+        touched = {month: copy.deepcopy(doc)}
+        apply_operations(touched, operations)
+
+        result = await db.expense_months.replace_one(doc, touched[month])
+        if result.matched_count:
+            return await bump_version(user_id, [month], year)
+    raise HTTPException(status_code=409, detail="Expense is being changed concurrently; try again.")
+
+# Monthly storage, several months: the version counter and every touched month
+# document are read and rewritten in one transaction, which needs a replica
+# set. A concurrent write to any of them aborts it, and with_transaction runs
+# it again on the new data.
+async def patch_monthly(user_id, months, operations, if_match, year=None):
+    year = resolve_year(year)
+    if len(months) == 1:
+        return await patch_month(user_id, months[0], operations, if_match, year)
+    counter_id = f"{user_id}:{year}"
+
+    async def write(session):
+        counter = await db.expense_versions.find_one({"_id": counter_id}, session=session)
+        current = counter["version"] if counter else 0
+        check_if_match(if_match, current)
+
+        docs = await db.expense_months.find(
+            {"_id": {"$in": [month_doc_id(user_id, year, name) for name in months]}}, session=session
+        ).to_list(None)
+        if not docs:
+            await raise_not_found(user_id, "Month not found.")
+        touched = {doc["month"]: doc for doc in docs}
+        apply_operations(touched, operations)
+
+        version = current + 1
+        await db.expense_versions.update_one({"_id": counter_id}, {"$set": {"version": version}}, upsert=True, session=session)
+        await db.expense_months.bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, {**doc, "version": version}) for doc in docs], session=session
+        )
+        return version
+
+    async with client.start_session() as session:
+        return await session.with_transaction(write)
+
+# Reserve an Idempotency-Key for this request before applying it. Returns the
+# response of the earlier request that used the key, if it succeeded.
+async def claim_idempotency_key(user_id, key, request):
+    claim_id = f"{user_id}:{key}"
+    digest = hashlib.sha256(encode_json(request)).hexdigest()
+    try:
+        await db.idempotency_keys.insert_one({"_id": claim_id, "request": digest, "created_at": datetime.utcnow()})
+        return None
+    except DuplicateKeyError:
+        claimed = await db.idempotency_keys.find_one({"_id": claim_id})
+    if claimed and claimed["request"] != digest:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request.")
+    if not claimed or "response" not in claimed:
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress.")
+    return claimed["response"]
+
+# Several edits in one request, e.g. everything a user changed on a month.
+# They are validated together and written in one atomic step (in monthly
+# storage, a transaction when they span several months, which needs a replica
+# set). Send If-Match
+# with the ETag of a read to get a 412 rather than editing on top of someone
+# else's change, and an Idempotency-Key to make retries safe.
+@router.patch("/expenses/{user_id}")
+async def patch_expense(user_id: str, patch: ExpensePatch, year: Optional[int] = None,
+                        if_match: Optional[str] = Header(None), idempotency_key: Optional[str] = Header(None)):
+    try:
+        if idempotency_key:
+            request = {"year": year, **patch.dict()}
+            replay = await claim_idempotency_key(user_id, idempotency_key, request)
+            if replay is not None:
+                return FastResponse(replay, headers={"ETag": etag(replay["version"]), "Idempotent-Replayed": "true"})
+
+        months = list(dict.fromkeys(op.month for op in patch.operations))
+        try:
+            if EXPENSE_STORAGE == "monthly":
+                version = await patch_monthly(user_id, months, patch.operations, if_match, year)
+            else:
+                version = await patch_embedded(user_id, months, patch.operations, if_match)
+        except Exception:
+            # Nothing was written, so a retry with the same key may try again
+            if idempotency_key:
+                await db.idempotency_keys.delete_one({"_id": f"{user_id}:{idempotency_key}"})
+            raise
+
+        await expense_changed(user_id, months, year, bump=False)
+        result = {"message": "Expense updated successfully.", "version": version, "applied": len(patch.operations)}
+        if idempotency_key:
+            await db.idempotency_keys.update_one({"_id": f"{user_id}:{idempotency_key}"}, {"$set": {"response": result}})
+        return FastResponse(result, headers={"ETag": etag(version)})
+    except HTTPException:
+        # 404/409/412/422 mean different things to a client retrying a batch
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    
-@router.get("/leaderboard")
-async def leaderboard(month: str):
+
+# Expression that is true when a month's stored totals differ from its line items
+def totals_mismatch(month):
+    computed = totals_expression(month)["$let"]
+    return {"$let": {"vars": computed["vars"], "in": {"$or": [
+        {"$ne": [f"{month}.{field}", expected]} for field, expected in computed["in"].items()
+    ]}}}
+
+# Check the running totals against the line items and rewrite the ones that
+# drifted (or predate them), server-side. Returns how many documents were fixed.
+@job
+async def reconcile_totals(user_id=None, batch_size=1000):
+    collection = expense_collection()
+    if EXPENSE_STORAGE == "monthly":
+        query = {"$expr": totals_mismatch("$$ROOT")}
+        if user_id is not None:
+            query["user_id"] = user_id
+        fix = [{"$replaceWith": {"$mergeObjects": ["$$ROOT", totals_expression("$$ROOT")]}}]
+    else:
+        query = {"$expr": {"$anyElementTrue": [{"$map": {"input": "$months", "as": "m", "in": totals_mismatch("$$m")}}]}}
+        if user_id is not None:
+            query["_id"] = user_id
+        fix = [{"$set": {"months": {"$map": {
+            "input": "$months",
+            "as": "m",
+            "in": {"$mergeObjects": ["$$m", totals_expression("$$m")]}
+        }}}}]
+
+    fixed = 0
+    stale = []
+
+    async def repair():
+        nonlocal fixed, stale
+        if stale:
+            await collection.update_many({"_id": {"$in": [doc["_id"] for doc in stale]}}, fix)
+            for doc in stale:
+                if EXPENSE_STORAGE == "monthly":
+                    await expense_changed(doc["user_id"], [doc["month"]], doc["year"])
+                else:
+                    await expense_changed(doc["_id"])
+            fixed += len(stale)
+            stale = []
+
+    async for doc in collection.find(query, {"user_id": 1, "year": 1, "month": 1}):
+        stale.append(doc)
+        if len(stale) >= batch_size:
+            await repair()
+    await repair()
+    return fixed
+
+# Periodic jobs run in one worker at a time across every process and host:
+# each run goes to whichever worker holds the job's lease in Mongo. The holder
+# renews it on every run, and anyone may take it once it has lapsed.
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+async def hold_lease(name, seconds):
+    now = datetime.utcnow()
+    try:
+        await db.leases.update_one(
+            {"_id": name, "$or": [{"holder": worker_id()}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": worker_id(), "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        # Held by another worker: the filter missed and the upsert hit its _id
+        return False
+
+async def schedule_reconcile(lease, seconds):
     try:
-        users = db.customer_details.find({})
-        leaderboard = []
-        for user in users:
-            userid = user["userid"]
-            expenses = db.expenses.find_one({"_id": userid})
-            if expenses:
-                for m in expenses["months"]:
-                    if m["month"] == month:
-                        total_savings = m["monthly_budget"] - m["amount_spent"]
-                        leaderboard.append({"userid": userid, "total_savings": total_savings})
-                        break
-        leaderboard = sorted(leaderboard, key=lambda x: x["total_savings"], reverse=True)
-        return leaderboard
+        if await hold_lease(lease, seconds):
+            await task_queue.enqueue("reconcile_totals")
+    except Exception:
+        logger.exception("Scheduling reconciliation failed")
+
+# Also once at startup, by the first worker of a deploy to take the short
+# startup lease, so documents from before running totals (or with drifted
+# ones) are fixed right away rather than a whole interval later
+async def reconcile_periodically():
+    await schedule_reconcile("reconcile_totals_startup", RECONCILE_STARTUP_LEASE_SECONDS)
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+        await schedule_reconcile("reconcile_totals", RECONCILE_INTERVAL_SECONDS * 2)
+
+# ?background=true queues the scan and returns at once instead of the count
+@admin_router.post("/admin/reconcile")
+async def reconcile(user_id: Optional[str] = None, background: bool = False):
+    try:
+        if background:
+            return {"queued": await task_queue.enqueue("reconcile_totals", user_id)}
+        return {"fixed": await reconcile_totals(user_id)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-app.include_router(router)
+# Decode a streamed body into lines without holding the whole upload
+async def stream_lines(request):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+# Turn NDJSON or CSV (with a month,category,sub_category,amount header) lines
+# into (line_number, dict) pairs
+async def parse_bulk_rows(request, fmt):
+    header = None
+    line_number = 0
+    async for line in stream_lines(request):
+        line_number += 1
+        if not line.strip():
+            continue
+        if fmt == "csv":
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [h.strip() for h in values]
+                continue
+            yield line_number, dict(zip(header, values))
+        else:
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                yield line_number, e
+
+# Bulk import of line items from a streamed NDJSON or CSV body. Rows are
+# checked against a per-request copy of the budgets and written per (month,
+# category) group, each group guarded by the remaining budget in Mongo like
+# add_subcategory, so a write landing during a long upload can't push a
+# category over budget. Months already written are reported as changed even
+# if the upload then fails or the client goes away.
+@router.post("/expenses/{user_id}/bulk")
+async def bulk_add_subcategories(user_id: str, request: Request, year: Optional[int] = None):
+    try:
+        content_type = request.headers.get("content-type", "")
+        fmt = "csv" if "csv" in content_type else "ndjson"
+
+        # Per (month, category) remaining budget, loaded once per month
+        budgets = {}
+        pending = {}
+        pending_rows = 0
+        accepted = rejected = 0
+        errors = []
+        written_months = set()
+
+        def reject(line_number, error):
+            nonlocal rejected
+            rejected += 1
+            if len(errors) < BULK_MAX_ERRORS:
+                errors.append({"line": line_number, "error": error})
+
+        async def flush():
+            nonlocal pending, pending_rows, accepted
+            groups, pending, pending_rows = pending, {}, 0
+            for (month, category), rows in groups.items():
+                spent = sum(sub["amount_spent"] for _, sub in rows)
+                scope = month_scope(user_id, month, year, {"categories": {"$elemMatch": {
+                    "category": category,
+                    "remaining_budget": {"$gte": spent},
+                }}})
+                result = await scope.collection.update_one(
+                    scope.filter,
+                    {
+                        "$push": {f"{scope.prefix}categories.$[c].sub_categories": {"$each": [sub for _, sub in rows]}},
+                        "$inc": spend_increments(scope, spent),
+                    },
+                    array_filters=scope.array_filters + [{"c.category": category}],
+                )
+                if result.matched_count:
+                    written_months.add(month)
+                    continue
+                # Changed by another write since the budgets were read: nothing
+                # of the group was written, and the month is read again
+                accepted -= len(rows)
+                budgets.pop(month, None)
+                for line_number, _ in rows:
+                    reject(line_number, "Category was changed or went over budget during the upload.")
+
+        try:
+            async for line_number, raw in parse_bulk_rows(request, fmt):
+                if isinstance(raw, Exception):
+                    reject(line_number, f"Invalid JSON: {raw}")
+                    continue
+                try:
+                    row = BulkExpenseRow(**raw)
+                except (ValidationError, TypeError) as e:
+                    reject(line_number, str(e))
+                    continue
+
+                if row.month not in MONTHS:
+                    reject(line_number, f"Unknown month: {row.month}")
+                    continue
+                if row.month not in budgets:
+                    try:
+                        m = await find_month(user_id, row.month, year)
+                        if not has_totals(m):
+                            await reconcile_totals(user_id)
+                            m = await find_month(user_id, row.month, year)
+                    except HTTPException as e:
+                        if e.detail == "Expense not found.":
+                            raise
+                        reject(line_number, e.detail)
+                        continue
+                    budgets[row.month] = {c["category"]: c["remaining_budget"] for c in m["categories"]}
+
+                remaining_budget = budgets[row.month].get(row.category)
+                if remaining_budget is None:
+                    reject(line_number, "Category not found.")
+                    continue
+                if row.amount > remaining_budget:
+                    reject(line_number, f"Expense exceeds remaining budget. Remaining budget: ${remaining_budget}")
+                    continue
+
+                budgets[row.month][row.category] -= row.amount
+                pending.setdefault((row.month, row.category), []).append(
+                    (line_number, {"sub_category": row.sub_category, "amount_spent": row.amount}))
+                pending_rows += 1
+                accepted += 1
+                if pending_rows >= BULK_FLUSH_ROWS:
+                    await flush()
+
+            await flush()
+        finally:
+            if written_months:
+                await expense_changed(user_id, sorted(written_months, key=MONTHS.index), year)
+        return {"accepted": accepted, "rejected": rejected, "errors": errors}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Savings ranking for one month, computed server-side in a single pass over expenses
+def leaderboard_pipeline(month, user_id=None, year=None):
+    if EXPENSE_STORAGE == "monthly":
+        match = {"year": resolve_year(year), "month": month}
+        if user_id is not None:
+            match["user_id"] = user_id
+        return [
+            {"$match": match},
+            {"$project": {
+                "_id": "$user_id",
+                "userid": "$user_id",
+                "total_savings": {"$subtract": ["$monthly_budget", "$amount_spent"]}
+            }},
+        ]
+
+    pipeline = [{"$match": {"months.month": month}}]
+    if user_id is not None:
+        pipeline[0]["$match"]["_id"] = user_id
+    pipeline += [
+        {"$unwind": "$months"},
+        {"$match": {"months.month": month}},
+        {"$project": {
+            "userid": "$_id",
+            "total_savings": {"$subtract": ["$months.monthly_budget", "$months.amount_spent"]}
+        }},
+    ]
+    return pipeline
+
+def leaderboard_name(month, year=None):
+    if EXPENSE_STORAGE == "monthly":
+        return f"leaderboard_{resolve_year(year)}_{month}"
+    return f"leaderboard_{month}"
+
+# Leaderboards this process knows are fully built. Which ones exist is
+# recorded in materialized_leaderboards, so every worker keeps a leaderboard
+# up to date once any worker has built it. The record is written before the
+# first build, so writes handled meanwhile already merge their user's row.
+_materialized_leaderboards = set()
+
+# (Re)build the materialized leaderboard for every user, or only for user_id
+async def materialize_leaderboard(month, user_id=None, year=None):
+    pipeline = leaderboard_pipeline(month, user_id, year)
+    pipeline.append({"$merge": {"into": leaderboard_name(month, year), "on": "_id", "whenMatched": "replace"}})
+    # $merge returns no documents; the write happens once the cursor is drained
+    await (await expense_collection().aggregate(pipeline)).to_list(None)
+
+async def ensure_leaderboard(month, year=None):
+    name = leaderboard_name(month, year)
+    if name in _materialized_leaderboards:
+        return
+    if not await db.materialized_leaderboards.count_documents({"_id": name, "built": True}, limit=1):
+        await db.materialized_leaderboards.update_one({"_id": name}, {"$setOnInsert": {"built": False}}, upsert=True)
+        await db[name].create_index([("total_savings", DESCENDING), ("userid", ASCENDING)])
+        await materialize_leaderboard(month, year=year)
+        await db.materialized_leaderboards.update_one({"_id": name}, {"$set": {"built": True}})
+    _materialized_leaderboards.add(name)
+
+# Queued by expense_changed after any write that may change amount_spent or
+# monthly_budget
+@job
+async def refresh_leaderboard(user_id, months=MONTHS, year=None):
+    if not MATERIALIZE_LEADERBOARD:
+        return
+    names = {leaderboard_name(month, year): month for month in months}
+    unknown = [name for name in names if name not in _materialized_leaderboards]
+    recorded = set()
+    if unknown:
+        async for doc in db.materialized_leaderboards.find({"_id": {"$in": unknown}}):
+            recorded.add(doc["_id"])
+            if doc.get("built"):
+                _materialized_leaderboards.add(doc["_id"])
+    for name, month in names.items():
+        if name in _materialized_leaderboards or name in recorded:
+            await materialize_leaderboard(month, user_id, year)
+
+async def top_savers(month, limit=None, offset=0, year=None, source=None):
+    if month not in MONTHS:
+        return []
+    source = source if source is not None else db
+    if MATERIALIZE_LEADERBOARD:
+        await ensure_leaderboard(month, year)
+        cursor = source[leaderboard_name(month, year)].find({}, {"_id": 0}).sort([("total_savings", DESCENDING), ("userid", ASCENDING)]).skip(offset)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(None)
+
+    pipeline = leaderboard_pipeline(month, year=year)
+    pipeline += [{"$project": {"_id": 0}}, {"$sort": {"total_savings": -1, "userid": 1}}, {"$skip": offset}]
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    return await (await expense_collection(source).aggregate(pipeline)).to_list(None)
+
+# Leaderboards carry no version, so their ETag is a digest of the entries
+def leaderboard_tag(entries):
+    return f'"{hashlib.sha1(json.dumps(entries, sort_keys=True).encode()).hexdigest()}"'
+
+@router.get("/leaderboard", response_model=list[LeaderboardEntryOut])
+async def leaderboard(month: str, limit: Optional[int] = Query(None, ge=1), offset: int = Query(0, ge=0),
+                      year: Optional[int] = None, if_none_match: Optional[str] = Header(None)):
+    try:
+        entries = await top_savers(month, limit, offset, year, read_source())
+        tag = leaderboard_tag(entries)
+        if not_modified(if_none_match, tag):
+            return Response(status_code=304, headers={"ETag": tag})
+        return FastResponse(entries, headers={"ETag": tag})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Expense data as {"user_id", "year", "months"}, for all users or only user_ids
+async def expense_documents(user_ids=None):
+    if EXPENSE_STORAGE == "monthly":
+        query = {} if user_ids is None else {"user_id": {"$in": user_ids}}
+        async for doc in db.expense_months.find(query):
+            yield {"user_id": doc["user_id"], "year": doc["year"], "months": [doc]}
+    else:
+        query = {} if user_ids is None else {"_id": {"$in": user_ids}}
+        async for doc in db.expenses.find(query):
+            yield {"user_id": doc["_id"], "year": resolve_year(None), "months": doc["months"]}
+
+# Runs of refresh_snapshot never overlap: within a worker they queue on this
+# lock, and across workers and hosts only the holder of the refresh_analytics
+# lease runs one. Overlapping runs would clobber each other's shard files
+# while both cleared analytics_dirty.
+_analytics_refresh = asyncio.Lock()
+
+# Returns None, without refreshing, if another worker holds the lease
+async def refresh_analytics():
+    async with _analytics_refresh:
+        if not await hold_lease("refresh_analytics", ANALYTICS_LEASE_SECONDS):
+            return None
+        return await refresh_snapshot()
+
+# Rebuild the snapshot if there is none, otherwise re-export only the users
+# marked in analytics_dirty since the last refresh. Either way documents are
+# read ANALYTICS_REFRESH_BATCH at a time and flattened and written in a
+# thread, so neither memory nor event loop stalls grow with the user base.
+async def refresh_snapshot():
+    month_numbers = {month: i + 1 for i, month in enumerate(MONTHS)}
+    cutoff = datetime.utcnow()
+    if not analytics.snapshot_exists():
+        await db.analytics_dirty.delete_many({"changed_at": {"$lte": cutoff}})
+        build = await asyncio.to_thread(analytics.FullBuild)
+        users = set()
+        batch = []
+
+        async def add_batch():
+            shards = await asyncio.to_thread(analytics.collect_rows, batch, month_numbers)
+            await asyncio.to_thread(build.add, shards)
+            for rows in shards.values():
+                users.update(rows.users)
+
+        async for doc in expense_documents():
+            batch.append(doc)
+            if len(batch) >= ANALYTICS_REFRESH_BATCH:
+                await add_batch()
+                batch = []
+        await add_batch()
+        await asyncio.to_thread(build.finish)
+        return {"mode": "full", "users": len(users)}
+
+    refreshed = 0
+    while True:
+        dirty = await db.analytics_dirty.find({"changed_at": {"$lte": cutoff}}, {"_id": 1}).limit(ANALYTICS_REFRESH_BATCH).to_list(None)
+        if not dirty:
+            return {"mode": "incremental", "users": refreshed}
+        user_ids = [doc["_id"] for doc in dirty]
+        shards = await asyncio.to_thread(analytics.collect_rows, [doc async for doc in expense_documents(user_ids)], month_numbers)
+        # Users without expense data anymore still get their old rows dropped
+        for user_id in user_ids:
+            shards.setdefault(analytics.shard_of(user_id), analytics.ShardRows()).users.add(user_id)
+        await asyncio.to_thread(analytics.write_shards, shards)
+        # A user changed again after `cutoff` stays marked for the next run
+        await db.analytics_dirty.delete_many({"_id": {"$in": user_ids}, "changed_at": {"$lte": cutoff}})
+        refreshed += len(user_ids)
+
+# With several hosts, ANALYTICS_DIR has to be shared storage: one worker
+# refreshes the snapshot and clears analytics_dirty for everyone
+async def refresh_analytics_periodically():
+    while True:
+        try:
+            await refresh_analytics()
+        except Exception:
+            logger.exception("Refreshing the analytics snapshot failed")
+        await asyncio.sleep(ANALYTICS_REFRESH_SECONDS)
+
+def require_analytics():
+    if not ANALYTICS_SNAPSHOT:
+        raise HTTPException(status_code=404, detail="Analytics snapshot is disabled.")
+
+@router.post("/analytics/refresh")
+async def analytics_refresh():
+    require_analytics()
+    try:
+        result = await refresh_analytics()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=409, detail="Analytics are refreshed by another worker.")
+    return result
+
+@router.get("/analytics/category-spend")
+async def analytics_category_spend(month: str, year: Optional[int] = None):
+    require_analytics()
+    return await asyncio.to_thread(analytics.category_spend, resolve_year(year), month)
+
+@router.get("/analytics/savings-percentiles")
+async def analytics_savings_percentiles(month: str, year: Optional[int] = None):
+    require_analytics()
+    return await asyncio.to_thread(analytics.savings_percentiles, resolve_year(year), month)
+
+@router.get("/analytics/month-over-month")
+async def analytics_month_over_month(year: Optional[int] = None):
+    require_analytics()
+    return await asyncio.to_thread(analytics.month_over_month, resolve_year(year))
+
+# Subscriptions are per (user_id, year); embedded storage has no year
+def live_key(user_id, year=None):
+    return (user_id, resolve_year(year) if EXPENSE_STORAGE == "monthly" else None)
+
+# One change stream over the whole database: expense writes mark their user,
+# and (unless the leaderboard is materialized, whose own collections are
+# followed instead) every expense write may move a ranking
+async def live_changes():
+    expense_coll = expense_collection().name
+    pipeline = [
+        {"$match": {"$or": [{"ns.coll": expense_coll}, {"ns.coll": {"$regex": "^leaderboard_"}}]}},
+        {"$project": {"ns": 1, "documentKey": 1}},
+    ]
+    async with await db.watch(pipeline) as stream:
+        async for change in stream:
+            if change["ns"]["coll"] != expense_coll:
+                yield "leaderboard", None
+                continue
+            if EXPENSE_STORAGE == "monthly":
+                user_id, year, _ = change["documentKey"]["_id"].rsplit(":", 2)
+                yield "expense", (user_id, int(year))
+            else:
+                yield "expense", (change["documentKey"]["_id"], None)
+            if not MATERIALIZE_LEADERBOARD:
+                yield "leaderboard", None
+
+async def live_expense(key):
+    expense = await load_expense(*key)
+    return convert_object_id(expense) if expense else None
+
+async def live_leaderboard(key):
+    month, year, limit = key
+    return await top_savers(month, limit, year=year)
+
+# Polling fallback: the version counter of each subscribed (user_id, year)
+async def live_versions(keys):
+    if EXPENSE_STORAGE == "monthly":
+        ids = {f"{user_id}:{year}": (user_id, year) for user_id, year in keys}
+        docs = db.expense_versions.find({"_id": {"$in": list(ids)}})
+        return {ids[doc["_id"]]: doc["version"] async for doc in docs}
+    docs = db.expenses.find({"_id": {"$in": [user_id for user_id, _ in keys]}}, {"version": 1})
+    return {(doc["_id"], None): doc.get("version", 0) async for doc in docs}
+
+live_hub = LiveHub(
+    live_changes, live_expense, live_leaderboard, live_versions,
+    coalesce_seconds=float(os.getenv("LIVE_COALESCE_MS", "100")) / 1000,
+    poll_seconds=float(os.getenv("LIVE_POLL_SECONDS", "2")),
+    leaderboard_seconds=float(os.getenv("LIVE_LEADERBOARD_SECONDS", "2")),
+    retry_watch_seconds=float(os.getenv("LIVE_RETRY_WATCH_SECONDS", "60")),
+)
+metrics.collectors.append(live_hub.metric_lines)
+
+def sse(event, data):
+    return f"event: {event}\ndata: {encode_json(data).decode()}\n\n"
+
+# Wait on a subscription queue; None once `timeout` passes without an update
+async def next_update(queue, timeout):
+    try:
+        return await asyncio.wait_for(queue.get(), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+# Server-sent events with the months changed after `since`: first a catch-up
+# event if the client is already behind, then one event per change
+@router.get("/expenses/{user_id}/events")
+async def expense_events(user_id: str, since: int = 0, year: Optional[int] = None):
+    async def stream():
+        current = since
+        async with live_hub.subscribe_expense(live_key(user_id, year)) as queue:
+            # Subscribed before loading, so nothing written in between is missed
+            expense = await live_expense(live_key(user_id, year))
+            while True:
+                if expense and expense.get("version", 0) > current:
+                    yield sse("expense", expense_delta(expense, current))
+                    current = expense["version"]
+                expense = await next_update(queue, LIVE_KEEPALIVE_SECONDS)
+                if expense is None:
+                    yield ": keepalive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Long-poll form of the same feed for clients that can't hold a stream open:
+# answers with the delta as soon as the version passes `since`, or 304 once
+# `timeout` seconds pass with no change
+@router.get("/expenses/{user_id}/wait", response_model=ExpenseOut)
+async def wait_for_expense(user_id: str, since: int, timeout: float = Query(25, ge=0), year: Optional[int] = None):
+    try:
+        key = live_key(user_id, year)
+        deadline = asyncio.get_running_loop().time() + min(timeout, LIVE_MAX_WAIT_SECONDS)
+        async with live_hub.subscribe_expense(key) as queue:
+            expense = await live_expense(key)
+            if not expense:
+                raise HTTPException(status_code=404, detail="Expense not found.")
+            while expense.get("version", 0) <= since:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    return Response(status_code=304, headers={"ETag": etag(expense.get("version"))})
+                expense = await next_update(queue, remaining) or expense
+        return FastResponse(expense_delta(expense, since))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/leaderboard/events")
+async def leaderboard_events(month: str, limit: Optional[int] = Query(None, ge=1), year: Optional[int] = None):
+    async def stream():
+        key = (month, year, limit)
+        async with live_hub.subscribe_leaderboard(key) as queue:
+            entries = await live_leaderboard(key)
+            while True:
+                if entries is not None:
+                    yield sse("leaderboard", {"month": month, "entries": entries})
+                entries = await next_update(queue, LIVE_KEEPALIVE_SECONDS)
+                if entries is None:
+                    yield ": keepalive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Long-poll for the leaderboard: returns once the entries differ from the ETag
+# sent in If-None-Match, or 304 after `timeout`
+@router.get("/leaderboard/wait", response_model=list[LeaderboardEntryOut])
+async def wait_for_leaderboard(month: str, limit: Optional[int] = Query(None, ge=1), timeout: float = Query(25, ge=0),
+                               year: Optional[int] = None, if_none_match: Optional[str] = Header(None)):
+    try:
+        key = (month, year, limit)
+        deadline = asyncio.get_running_loop().time() + min(timeout, LIVE_MAX_WAIT_SECONDS)
+        async with live_hub.subscribe_leaderboard(key) as queue:
+            entries = await live_leaderboard(key)
+            while not_modified(if_none_match, leaderboard_tag(entries)):
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    return Response(status_code=304, headers={"ETag": leaderboard_tag(entries)})
+                entries = await next_update(queue, remaining) or entries
+        return FastResponse(entries, headers={"ETag": leaderboard_tag(entries)})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/live/stats")
+async def live_stats():
+    return live_hub.stats()
+
+@router.get("/limits/stats")
+async def limits_stats():
+    return limiter.stats()
+
+@router.get("/cache/stats")
+async def cache_stats():
+    return {"backend": expense_cache.backend, "size": expense_cache.size(), **expense_cache.stats.as_dict()}
+
+def cache_metrics():
+    stats = expense_cache.stats.as_dict()
+    lines = []
+    for name in ("hits", "misses", "evictions", "expirations", "invalidations", "stale_sets"):
+        lines += [f"# TYPE expense_cache_{name}_total counter", f'expense_cache_{name}_total{{backend="{expense_cache.backend}"}} {stats[name]}']
+    return lines
+
+metrics.collectors.append(cache_metrics)
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Profiles captured by ProfilingMiddleware in this worker (see profiling.py),
+# newest first
+@admin_router.get("/admin/profiles")
+async def list_profiles(route: Optional[str] = None):
+    return [p.summary() for p in reversed(profiling.profiles) if route is None or p.route == route]
+
+@admin_router.get("/admin/profiles/collapsed", response_class=PlainTextResponse)
+async def collapsed_profiles(route: Optional[str] = None):
+    selected = [p for p in profiling.profiles if route is None or p.route == route]
+    return PlainTextResponse(profiling.merged_collapsed(selected),
+                             headers={"Content-Disposition": 'attachment; filename="profiles.collapsed"'})
+
+def find_profile(profile_id):
+    profile = next((p for p in profiling.profiles if p.id == profile_id), None)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found.")
+    return profile
+
+@admin_router.get("/admin/profiles/{profile_id}")
+async def profile_detail(profile_id: int):
+    return find_profile(profile_id).detail()
+
+@admin_router.get("/admin/profiles/{profile_id}/collapsed", response_class=PlainTextResponse)
+async def profile_collapsed(profile_id: int):
+    return PlainTextResponse(profiling.merged_collapsed([find_profile(profile_id)]),
+                             headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.collapsed"'})
+
+# Indexes every route relies on; create_index is a no-op when they already exist
+async def ensure_indexes():
+    await db.customer_details.create_index([("userid", ASCENDING)], unique=True)
+    await db.expenses.create_index([("months.month", ASCENDING)])
+    await db.expense_months.create_index([("user_id", ASCENDING), ("year", ASCENDING), ("month_number", ASCENDING)])
+    await db.expense_months.create_index([("year", ASCENDING), ("month", ASCENDING)])
+    await db.idempotency_keys.create_index([("created_at", ASCENDING)], expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+
+def plan_stages(explain):
+    stages = []
+    if isinstance(explain, dict):
+        if "stage" in explain:
+            stages.append(explain["stage"])
+        for key, value in explain.items():
+            if key not in ("rejectedPlans", "allPlansExecution"):
+                stages.extend(plan_stages(value))
+    elif isinstance(explain, list):
+        for value in explain:
+            stages.extend(plan_stages(value))
+    return stages
+
+# Explain the query behind each route with representative arguments
+async def explain_route_queries():
+    sample_user, sample_month = "explain-user", MONTHS[0]
+    scope = month_scope(sample_user, sample_month, conditions={"categories.category": "Food"})
+    if EXPENSE_STORAGE == "monthly":
+        read_query = db.expense_months.find({"user_id": sample_user, "year": resolve_year(None)}).sort("month_number", ASCENDING)
+    else:
+        read_query = db.expenses.find({"_id": sample_user})
+    plans = {
+        "login_user": await db.customer_details.find({"userid": sample_user}).explain(),
+        "read_expense": await read_query.explain(),
+        "month_update": await scope.collection.find(scope.filter).explain(),
+        "leaderboard": await db.command("explain", {
+            "aggregate": expense_collection().name,
+            "pipeline": leaderboard_pipeline(sample_month),
+            "cursor": {},
+        }),
+    }
+    if MATERIALIZE_LEADERBOARD:
+        plans["leaderboard_materialized"] = await db[leaderboard_name(sample_month)].find({}).sort(
+            [("total_savings", DESCENDING), ("userid", ASCENDING)]).explain()
+
+    return {name: plan_stages(plan) for name, plan in plans.items()}
+
+@admin_router.get("/diagnostics/query-plans")
+async def query_plans():
+    stages = await explain_route_queries()
+    scans = [name for name, route_stages in stages.items() if "COLLSCAN" in route_stages]
+    if scans:
+        raise HTTPException(status_code=500, detail={"collscan": scans, "stages": stages})
+    return stages
+
+# Checked once per request with an HMAC, instead of the password's scrypt hash
+async def require_session(request: Request, authorization: Optional[str] = Header(None)):
+    user_id = request.path_params.get("user_id")
+    if not REQUIRE_SESSION or user_id is None:
+        return
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or auth.verify_token(token) != user_id:
+        raise HTTPException(status_code=401, detail="Invalid or expired session", headers={"WWW-Authenticate": "Bearer"})
+
+# Admin routes reconcile every user and expose other users' query profiles
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin routes are disabled; set ADMIN_TOKEN to enable them.")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token.")
+
+# One app per worker process: `WEB_CONCURRENCY=4 uvicorn main:app` (uvicorn
+# and gunicorn take their worker count from it), or
+# `uvicorn main:create_app --factory`. Each worker has its own Mongo client,
+# task queue and live hub; what must agree between workers is shared through
+# Mongo (versions, leases, idempotency keys), CACHE_BACKEND=redis and
+# SESSION_SECRET.
+def create_app():
+    app = FastAPI(lifespan=lifespan, default_response_class=FastResponse)
+    if profiling.ENABLED:
+        app.add_middleware(profiling.ProfilingMiddleware)
+    app.add_middleware(NegotiationMiddleware)
+    app.add_middleware(MetricsMiddleware, slow_request_seconds=float(SLOW_REQUEST_MS) / 1000 if SLOW_REQUEST_MS else None)
+    # Dependencies run in order: a request without a valid session is
+    # rejected before it can take a token from anyone's rate limit bucket
+    app.include_router(router, dependencies=[Depends(require_session), Depends(limiter.admit)])
+    app.include_router(admin_router, dependencies=[Depends(require_admin), Depends(limiter.admit)])
+    if expense_cache.backend == "memory" and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        logger.warning(
+            "CACHE_BACKEND=memory with WEB_CONCURRENCY=%s: each worker caches on its own and a write only "
+            "invalidates its own worker's copy; use CACHE_BACKEND=redis", os.getenv("WEB_CONCURRENCY"))
+    return app
+
+app = create_app()
+
+# python main.py check-indexes: create indexes and exit non-zero on any COLLSCAN
+if __name__ == "__main__" and sys.argv[1:] == ["check-indexes"]:
+    async def check_indexes():
+        await ensure_indexes()
+        stages = await explain_route_queries()
+        for name, route_stages in stages.items():
+            print(f"{name}: {' <- '.join(route_stages)}")
+        return any("COLLSCAN" in route_stages for route_stages in stages.values())
+
+    sys.exit(1 if asyncio.run(check_indexes()) else 0)
@@ -0,0 +1,192 @@
+"""Request and Mongo instrumentation, exported in Prometheus text format.
+
+MetricsMiddleware records per-route latency, status codes and payload sizes.
+MongoCommandListener (registered on the Mongo client) counts every command
+and attributes it to the request that issued it through a context variable,
+so /metrics shows e.g. how many Mongo operations one leaderboard call costs.
+"""
+import logging
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+import profiling
+
+logger = logging.getLogger("metrics")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 1000)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.total += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class RequestStats:
+    def __init__(self):
+        self.mongo_ops = 0
+        self.mongo_seconds = 0.0
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.request_seconds = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.request_bytes = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.response_bytes = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.mongo_ops_per_request = defaultdict(lambda: Histogram(COUNT_BUCKETS))
+        self.mongo_seconds_per_request = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.responses = defaultdict(int)
+        self.mongo_commands = defaultdict(int)
+        self.mongo_command_seconds = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.tasks = defaultdict(int)
+        self.task_seconds = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        # Extra text blocks from other modules (cache, queues, limiters)
+        self.collectors = []
+
+    def observe_request(self, method, route, status, seconds, request_bytes, response_bytes, stats):
+        key = (method, route)
+        self.request_seconds[key].observe(seconds)
+        self.request_bytes[key].observe(request_bytes)
+        self.response_bytes[key].observe(response_bytes)
+        self.mongo_ops_per_request[key].observe(stats.mongo_ops)
+        self.mongo_seconds_per_request[key].observe(stats.mongo_seconds)
+        self.responses[(method, route, str(status))] += 1
+
+    def observe_command(self, command, outcome, seconds):
+        self.mongo_commands[(command, outcome)] += 1
+        self.mongo_command_seconds[command].observe(seconds)
+
+    # outcome: enqueued, deduplicated, succeeded, retried or failed; attempts
+    # that ran also record how long they took
+    def observe_task(self, job, outcome, seconds=None):
+        self.tasks[(job, outcome)] += 1
+        if seconds is not None:
+            self.task_seconds[job].observe(seconds)
+
+    def render(self):
+        lines = []
+        request_labels = ("method", "route")
+        self._histograms(lines, "http_request_duration_seconds", "Request latency", request_labels, self.request_seconds)
+        self._histograms(lines, "http_request_size_bytes", "Request body size", request_labels, self.request_bytes)
+        self._histograms(lines, "http_response_size_bytes", "Response body size", request_labels, self.response_bytes)
+        self._histograms(lines, "http_request_mongo_operations", "Mongo commands issued per request", request_labels, self.mongo_ops_per_request)
+        self._histograms(lines, "http_request_mongo_seconds", "Time spent in Mongo per request", request_labels, self.mongo_seconds_per_request)
+        self._counters(lines, "http_responses_total", "Responses by status code", ("method", "route", "status"), self.responses)
+        self._counters(lines, "mongo_commands_total", "Mongo commands by outcome", ("command", "outcome"), self.mongo_commands)
+        self._histograms(lines, "mongo_command_duration_seconds", "Mongo command latency", ("command",), self.mongo_command_seconds)
+        self._counters(lines, "tasks_total", "Background jobs by outcome", ("job", "outcome"), self.tasks)
+        self._histograms(lines, "task_duration_seconds", "Background job attempt latency", ("job",), self.task_seconds)
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(names, values, extra=None):
+        pairs = list(zip(names, values)) + ([extra] if extra else [])
+        return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+    def _counters(self, lines, name, help_text, label_names, counters):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for values, value in sorted(counters.items()):
+            lines.append(f"{name}{self._labels(label_names, values)} {value}")
+
+    def _histograms(self, lines, name, help_text, label_names, histograms):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for values, histogram in sorted(histograms.items()):
+            values = values if isinstance(values, tuple) else (values,)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(label_names, values, ('le', bound))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(label_names, values, ('le', '+Inf'))} {histogram.total}")
+            lines.append(f"{name}_sum{self._labels(label_names, values)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(label_names, values)} {histogram.total}")
+
+
+metrics = Metrics()
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def _finished(self, event, outcome):
+        seconds = event.duration_micros / 1_000_000
+        metrics.observe_command(event.command_name, outcome, seconds)
+        profiling.record_span(f"mongo.{event.command_name}", seconds)
+        stats = current_request.get()
+        if stats is not None:
+            stats.mongo_ops += 1
+            stats.mongo_seconds += seconds
+
+    def succeeded(self, event):
+        self._finished(event, "success")
+
+    def failed(self, event):
+        self._finished(event, "failure")
+
+
+class MetricsMiddleware:
+    def __init__(self, app, slow_request_seconds=None):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+        request_bytes = response_bytes = 0
+        start = time.perf_counter()
+
+        async def counting_receive():
+            nonlocal request_bytes
+            message = await receive()
+            request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            seconds = time.perf_counter() - start
+            current_request.reset(token)
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            metrics.observe_request(scope["method"], route_path, status, seconds, request_bytes, response_bytes, stats)
+            if self.slow_request_seconds is not None and seconds >= self.slow_request_seconds:
+                logger.warning(
+                    "Slow request: %s %s -> %s in %.1f ms (%d Mongo ops, %.1f ms in Mongo)",
+                    scope["method"], scope["path"], status, seconds * 1000, stats.mongo_ops, stats.mongo_seconds * 1000,
+                )
@@ -0,0 +1,76 @@
+"""Convert embedded expense documents to the per-month storage layout.
+
+    python migrate_expenses.py --year 2024
+
+Every document in `expenses` becomes up to twelve `expense_months`
+documents for --year (default: current year). A month is only inserted if
+its _id doesn't exist yet, so re-running fills in what is missing and never
+overwrites months the API has written since. Months whose name isn't one of
+MONTHS are skipped and listed at the end, and with --delete-source their
+user's document is kept. Each user's version counter in expense_versions starts
+at the document's version, so later writes keep moving ETags and ?since=
+deltas forward. Start the API with EXPENSE_STORAGE=monthly afterwards.
+"""
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+from main import MONTHS, db, ensure_indexes, month_document, resolve_year
+
+
+async def migrate(year, batch_size, delete_source):
+    await ensure_indexes()
+
+    users = months = 0
+    operations, counters, migrated_ids = [], [], []
+    skipped = []
+
+    async def flush():
+        nonlocal operations, counters, migrated_ids, months
+        if operations:
+            result = await db.expense_months.bulk_write(operations, ordered=False)
+            months += result.upserted_count
+        if counters:
+            await db.expense_versions.bulk_write(counters, ordered=False)
+        if delete_source and migrated_ids:
+            await db.expenses.delete_many({"_id": {"$in": migrated_ids}})
+        operations, counters, migrated_ids = [], [], []
+
+    async for expense in db.expenses.find({}):
+        unknown = []
+        for month_data in expense.get("months", []):
+            if month_data.get("month") not in MONTHS:
+                unknown.append(month_data.get("month"))
+                continue
+            doc = month_document(expense["_id"], year, month_data)
+            insert = {field: value for field, value in doc.items() if field != "_id"}
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$setOnInsert": insert}, upsert=True))
+        if expense.get("version"):
+            counters.append(UpdateOne({"_id": f"{expense['_id']}:{year}"}, {"$max": {"version": expense["version"]}}, upsert=True))
+        if unknown:
+            skipped.append((expense["_id"], unknown))
+        else:
+            migrated_ids.append(expense["_id"])
+        users += 1
+        if len(operations) >= batch_size:
+            await flush()
+    await flush()
+
+    print(f"Migrated {users} users into expense_months ({year}): {months} new months.")
+    for user_id, names in skipped:
+        print(f"Skipped unknown months for {user_id}: {', '.join(map(repr, names))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--year", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--delete-source", action="store_true",
+                        help="remove each expenses document once its months are written")
+    args = parser.parse_args()
+    asyncio.run(migrate(resolve_year(args.year), args.batch_size, args.delete_source))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Opt-in per-request profiling, downloadable as collapsed stacks.
+
+With PROFILE_ENABLED=1, ProfilingMiddleware profiles a request when it
+carries the PROFILE_HEADER header (default "X-Profile") or is picked by
+PROFILE_SAMPLE_RATE (0.0-1.0). With it unset the middleware isn't installed
+at all, and span() costs one context variable lookup.
+
+Profilers (PROFILE_ENGINE):
+
+* pyinstrument (the default when installed): a sampling profiler that
+  follows the request's task across awaits, so time spent in other requests
+  while this one waits on Mongo shows up as await time, not as its own.
+* cprofile: the stdlib deterministic profiler. It records every call on the
+  event loop thread, including other requests' work during awaits, and only
+  knows caller -> callee pairs, so its collapsed stacks are an approximation.
+
+Only one request is profiled at a time per worker. Spans record how long each
+Mongo command (mongo.<command>) and each response encode (encode.<format>)
+took within the request. The last PROFILE_KEEP profiles are kept in memory
+and served by the /admin/profiles routes in main.py (which need ADMIN_TOKEN).
+Their collapsed stacks ("frame;frame;frame <microseconds>" per line) are the
+input format of flamegraph.pl, speedscope and inferno.
+"""
+import cProfile
+import itertools
+import os
+import pstats
+import random
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+HEADER = os.getenv("PROFILE_HEADER", "X-Profile").lower().encode()
+ENGINE = os.getenv("PROFILE_ENGINE", "pyinstrument" if pyinstrument is not None else "cprofile")
+INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "1")) / 1000
+KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# cProfile call graphs can be deep and cyclic; stacks are cut off here
+MAX_DEPTH = 64
+
+current_profile = ContextVar("current_profile", default=None)
+profiles = deque(maxlen=KEEP)
+_ids = itertools.count(1)
+_active = threading.Lock()
+
+
+class Profile:
+    def __init__(self, method, path):
+        self.id = next(_ids)
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status = None
+        self.engine = ENGINE
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.spans = []
+        self.collapsed = Counter()
+
+    def summary(self):
+        spans = Counter()
+        for name, _, seconds in self.spans:
+            spans[name] += seconds
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "engine": self.engine,
+            "started_at": self.started_at,
+            "ms": round(self.seconds * 1000, 3),
+            "span_ms": {name: round(seconds * 1000, 3) for name, seconds in spans.most_common()},
+        }
+
+    def detail(self):
+        return {**self.summary(), "spans": [
+            {"name": name, "offset_ms": round(offset * 1000, 3), "ms": round(seconds * 1000, 3)}
+            for name, offset, seconds in self.spans
+        ]}
+
+
+def record_span(name, seconds, ended=None):
+    profile = current_profile.get()
+    if profile is not None:
+        ended = ended if ended is not None else time.perf_counter()
+        profile.spans.append((name, ended - seconds - profile.start, seconds))
+
+
+@contextmanager
+def span(name):
+    if current_profile.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def frame_label(function, file_path, line_no):
+    return f"{function} ({os.path.basename(file_path)}:{line_no})"
+
+
+def collapse_pyinstrument(session):
+    collapsed = Counter()
+
+    def walk(frame, stack):
+        stack = stack + [frame_label(frame.function, frame.file_path_short or "", frame.line_no or 0)]
+        self_time = frame.time - sum(child.time for child in frame.children)
+        if self_time > 0:
+            collapsed[";".join(stack)] += round(self_time * 1_000_000)
+        for child in frame.children:
+            walk(child, stack)
+
+    root = session.root_frame()
+    if root is not None:
+        walk(root, [])
+    return collapsed
+
+
+# Rebuild stacks from cProfile's caller -> callee table, charging each edge
+# its own time within that caller
+def collapse_pstats(stats):
+    children = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            children.setdefault(caller, []).append((func, edge[2]))
+    collapsed = Counter()
+
+    def walk(func, own_time, stack, seen):
+        stack = stack + [frame_label(func[2], func[0], func[1])]
+        if own_time > 0:
+            collapsed[";".join(stack)] += round(own_time * 1_000_000)
+        if len(stack) >= MAX_DEPTH:
+            return
+        for child, child_time in children.get(func, ()):
+            if child not in seen:
+                walk(child, child_time, stack, seen | {child})
+
+    for func, (_, _, own_time, _, callers) in stats.items():
+        if not callers:
+            walk(func, own_time, [], {func})
+    return collapsed
+
+
+def start_profiler(engine):
+    if engine == "pyinstrument":
+        profiler = pyinstrument.Profiler(interval=INTERVAL_SECONDS, async_mode="enabled")
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler):
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        return collapse_pstats(pstats.Stats(profiler).stats)
+    return collapse_pyinstrument(profiler.stop())
+
+
+def merged_collapsed(selected):
+    collapsed = Counter()
+    for profile in selected:
+        collapsed.update(profile.collapsed)
+    return "".join(f"{stack} {micros}\n" for stack, micros in sorted(collapsed.items()))
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def wanted(self, scope):
+        if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+            return True
+        return any(name == HEADER and value not in (b"", b"0") for name, value in scope["headers"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.wanted(scope) or not _active.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        profile = Profile(scope["method"], scope["path"])
+        token = current_profile.set(profile)
+
+        async def tagged_send(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", str(profile.id).encode())]}
+            await send(message)
+
+        try:
+            profiler = start_profiler(profile.engine)
+            try:
+                await self.app(scope, receive, tagged_send)
+            finally:
+                profile.collapsed = stop_profiler(profiler)
+        finally:
+            current_profile.reset(token)
+            _active.release()
+            profile.seconds = time.perf_counter() - profile.start
+            route = scope.get("route")
+            profile.route = getattr(route, "path", "unmatched")
+            profiles.append(profile)
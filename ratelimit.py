@@ -0,0 +1,261 @@
+"""Rate limiting and admission control for expensive routes.
+
+Each route in the limits table (DEFAULT_LIMITS, or RATE_LIMITS as a JSON
+object keyed by "METHOD /route/{template}") can have either or both of:
+
+* rate/burst: a token bucket per (route, caller) refilling `rate` tokens a
+  second up to `burst`. The caller is the user of a valid session token,
+  else the client address (so everyone without a session behind one frontend
+  server shares a bucket). The {user_id} in the path is never used, since
+  anyone could send it to drain someone else's bucket. A route with `key`
+  set to a field of its JSON body (e.g. "userid" for /login) is keyed on
+  that field instead, falling back to the caller when it is missing: its
+  requests come without a session, and all of them through the one frontend
+  server. A request that finds the bucket empty gets 429 with Retry-After
+  set to when the next token arrives.
+* concurrency/queue: at most `concurrency` requests of the route run at once
+  in this worker. Up to `queue` more wait at most `queue_seconds` for a slot.
+  Anything past that gets 503 with Retry-After, so a burst fails fast
+  instead of piling up behind Mongo and stretching everyone's tail latency.
+
+Two bucket backends share the same async take() interface:
+
+* MemoryBuckets: in-process and bounded. Each uvicorn worker counts on its
+  own, so N workers admit up to N times the configured rate.
+* RedisBuckets: one atomic script per request against any
+  redis.asyncio-compatible client, shared by every worker and host. If Redis
+  is unreachable, requests are let through and counted as backend_error.
+
+Concurrency limits are always per worker. Decisions, in-flight and waiting
+counts are exported on /metrics and /limits/stats.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, defaultdict
+
+from fastapi import HTTPException, Request
+
+import auth
+from metrics import escape_label
+
+logger = logging.getLogger("ratelimit")
+
+# Scans over every user (leaderboard, analytics, reconcile) and write paths
+# that cost a scrypt hash or a full bulk import. /register has no per-caller
+# key worth a bucket (every registration is for a new userid), so only its
+# concurrency is limited; /login's bucket guards each account.
+DEFAULT_LIMITS = {
+    "GET /leaderboard": {"rate": 20, "burst": 40, "concurrency": 16, "queue": 64},
+    "POST /register": {"concurrency": 32, "queue": 128},
+    "POST /login": {"rate": 10, "burst": 50, "key": "userid", "concurrency": 32, "queue": 128},
+    "POST /expenses/{user_id}/bulk": {"rate": 0.2, "burst": 2, "concurrency": 2, "queue": 4},
+    "PATCH /expenses/{user_id}": {"rate": 10, "burst": 20},
+    "POST /analytics/refresh": {"concurrency": 1, "queue": 0},
+    "POST /admin/reconcile": {"concurrency": 1, "queue": 0},
+}
+
+
+class MemoryBuckets:
+    backend = "memory"
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+
+    # Seconds until a token is available; 0.0 means one was taken
+    async def take(self, key, rate, burst):
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        # The least recently used buckets go first; evicting one only forgets a debt
+        while len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+        return wait
+
+    async def close(self):
+        pass
+
+
+# Same refill-and-take as MemoryBuckets, atomically in Redis. The wait is
+# returned as a string, since Redis truncates Lua numbers to integers.
+TAKE_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    backend = "redis"
+
+    def __init__(self, client, prefix="rate-limit:"):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    async def take(self, key, rate, burst):
+        return float(await self._take(keys=[self.prefix + key], args=[rate, burst, time.time()]))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class ConcurrencyLimit:
+    def __init__(self, limit, queue, queue_seconds):
+        self.limit = limit
+        self.queue = queue
+        self.queue_seconds = queue_seconds
+        self.in_flight = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(limit)
+
+    # Returns the outcome: "admitted", "queued" (admitted after waiting),
+    # "shed_queue_full" or "shed_timeout"
+    async def acquire(self):
+        outcome = "admitted"
+        if self._slots.locked():
+            if self.waiting >= self.queue:
+                return "shed_queue_full"
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_seconds)
+            except asyncio.TimeoutError:
+                return "shed_timeout"
+            finally:
+                self.waiting -= 1
+            outcome = "queued"
+        else:
+            await self._slots.acquire()
+        self.in_flight += 1
+        return outcome
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+
+def caller_of(request):
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer":
+        user_id = auth.verify_token(token)
+        if user_id:
+            return f"user:{user_id}"
+    return f"addr:{request.client.host if request.client else 'unknown'}"
+
+
+# The bucket key for a route's requests: the `key` field of the JSON body if
+# the limit names one and the request has it, else the caller
+async def bucket_key(request, limit):
+    field = limit.get("key")
+    if field:
+        try:
+            value = (await request.json()).get(field)
+        except Exception:
+            value = None
+        if isinstance(value, str) and value:
+            return f"{field}:{value}"
+    return caller_of(request)
+
+
+def retry_after(seconds):
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+class Limiter:
+    def __init__(self, limits, buckets, queue_seconds=1.0):
+        self.limits = limits
+        self.buckets = buckets
+        self.concurrency = {
+            route: ConcurrencyLimit(limit["concurrency"], limit.get("queue", 0), limit.get("queue_seconds", queue_seconds))
+            for route, limit in limits.items() if limit.get("concurrency")
+        }
+        self.decisions = defaultdict(int)
+
+    # FastAPI dependency for every route, after require_session; it runs
+    # after routing, so the route template is known, and holds the
+    # concurrency slot until the response is done
+    async def admit(self, request: Request):
+        route = f"{request.method} {getattr(request.scope.get('route'), 'path', '')}"
+        limit = self.limits.get(route)
+        if limit is None:
+            yield
+            return
+
+        if limit.get("rate"):
+            try:
+                wait = await self.buckets.take(f"{route}:{await bucket_key(request, limit)}", limit["rate"], limit.get("burst", limit["rate"]))
+            except Exception:
+                logger.exception("Rate limit backend failed; admitting %s", route)
+                self.decisions[(route, "backend_error")] += 1
+                wait = 0.0
+            if wait > 0:
+                self.decisions[(route, "rate_limited")] += 1
+                raise HTTPException(status_code=429, detail="Too many requests.", headers=retry_after(wait))
+
+        slots = self.concurrency.get(route)
+        if slots is None:
+            self.decisions[(route, "admitted")] += 1
+            yield
+            return
+        outcome = await slots.acquire()
+        self.decisions[(route, outcome)] += 1
+        if outcome.startswith("shed"):
+            raise HTTPException(status_code=503, detail="Server busy.", headers=retry_after(slots.queue_seconds))
+        try:
+            yield
+        finally:
+            slots.release()
+
+    async def close(self):
+        await self.buckets.close()
+
+    def stats(self):
+        routes = defaultdict(dict)
+        for (route, outcome), count in sorted(self.decisions.items()):
+            routes[route][outcome] = count
+        for route, slots in self.concurrency.items():
+            routes[route].update({"in_flight": slots.in_flight, "waiting": slots.waiting})
+        return {"backend": self.buckets.backend, "limits": self.limits, "routes": routes}
+
+    def metric_lines(self):
+        lines = [
+            "# HELP admission_decisions_total Requests to limited routes by admission outcome",
+            "# TYPE admission_decisions_total counter",
+        ]
+        for (route, outcome), count in sorted(self.decisions.items()):
+            lines.append(f'admission_decisions_total{{route="{escape_label(route)}",outcome="{outcome}"}} {count}')
+        lines += ["# HELP admission_in_flight Requests running under a concurrency limit", "# TYPE admission_in_flight gauge"]
+        lines += [f'admission_in_flight{{route="{escape_label(route)}"}} {slots.in_flight}' for route, slots in self.concurrency.items()]
+        lines += ["# HELP admission_waiting Requests queued for a concurrency slot", "# TYPE admission_waiting gauge"]
+        lines += [f'admission_waiting{{route="{escape_label(route)}"}} {slots.waiting}' for route, slots in self.concurrency.items()]
+        return lines
+
+
+# RATE_LIMIT_BACKEND=memory (default) | redis; RATE_LIMITS='{}' turns limits off
+def make_limiter():
+    raw = os.getenv("RATE_LIMITS")
+    limits = json.loads(raw) if raw is not None else DEFAULT_LIMITS
+    if os.getenv("RATE_LIMIT_BACKEND", "memory") == "redis":
+        import redis.asyncio as redis
+
+        buckets = RedisBuckets(redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+    else:
+        buckets = MemoryBuckets(max_entries=int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000")))
+    return Limiter(limits, buckets, queue_seconds=float(os.getenv("ADMISSION_QUEUE_SECONDS", "1")))
@@ -0,0 +1,71 @@
+"""Response encoding for the API.
+
+FastResponse encodes with orjson when it is installed, falling back to the
+standard json module. Clients that send "Accept: application/msgpack" get
+msgpack instead, when msgpack is installed.
+
+Read routes wrap documents that come straight from Mongo in FastResponse
+themselves. Returning a Response skips FastAPI's jsonable_encoder walk and
+response_model validation, which both cost time proportional to the size of
+the months tree. The response models on those routes only describe the
+shape for the OpenAPI docs.
+"""
+import json
+from contextvars import ContextVar
+
+from starlette.responses import JSONResponse
+
+from profiling import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = "application/msgpack"
+
+# Set per request by NegotiationMiddleware, read when the body is rendered
+accepts_msgpack = ContextVar("accepts_msgpack", default=False)
+
+
+def encode_json(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=str, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def encode_msgpack(content):
+    return msgpack.packb(content, default=str, use_bin_type=True)
+
+
+# A JSONResponse subclass, so the OpenAPI docs still show the route's model
+class FastResponse(JSONResponse):
+
+    def __init__(self, content=None, status_code=200, headers=None, media_type=None, background=None):
+        super().__init__(content, status_code, headers, media_type, background)
+        if msgpack is not None:
+            self.headers["Vary"] = "Accept"
+
+    def render(self, content):
+        if msgpack is not None and accepts_msgpack.get():
+            self.media_type = MSGPACK
+            with span("encode.msgpack"):
+                return encode_msgpack(content)
+        with span("encode.json"):
+            return encode_json(content)
+
+
+class NegotiationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            accept = next((value for name, value in scope["headers"] if name == b"accept"), b"")
+            accepts_msgpack.set(MSGPACK.encode() in accept)
+        await self.app(scope, receive, send)
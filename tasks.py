@@ -0,0 +1,165 @@
+"""Background jobs for work that doesn't have to finish inside a request.
+
+Routes enqueue a job by name with JSON-serialisable arguments and return
+right away; the job runs later with bounded concurrency, and failures are
+retried with exponential backoff. Jobs are async functions registered with
+@job. An identical job (same name and arguments) that is still waiting in the
+queue is not enqueued twice.
+
+Two backends share the same async enqueue/start/stop interface:
+
+* LocalQueue: an asyncio.Queue drained by TASK_WORKERS workers in this
+  process. Jobs still queued when the process dies are lost, so every job must
+  be one that something else redoes eventually (the periodic reconcile, lazy
+  creation of month documents on first read).
+* InlineQueue: runs each job in the caller before enqueue returns, for scripts
+  and tests that want derived data to be up to date after every request.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from metrics import metrics, current_request
+
+logger = logging.getLogger("tasks")
+
+jobs = {}
+
+
+def job(func):
+    jobs[func.__name__] = func
+    return func
+
+
+async def run_job(name, args, max_attempts, retry_backoff):
+    for attempt in range(1, max_attempts + 1):
+        start = time.perf_counter()
+        try:
+            await jobs[name](*args)
+        except Exception:
+            seconds = time.perf_counter() - start
+            if attempt == max_attempts:
+                metrics.observe_task(name, "failed", seconds)
+                logger.exception("Job %s%r failed after %d attempts", name, tuple(args), attempt)
+                return False
+            metrics.observe_task(name, "retried", seconds)
+            await asyncio.sleep(retry_backoff * 2 ** (attempt - 1))
+        else:
+            metrics.observe_task(name, "succeeded", time.perf_counter() - start)
+            return True
+
+
+class LocalQueue:
+    backend = "local"
+
+    def __init__(self, workers=4, max_size=10000, max_attempts=3, retry_backoff=0.5, drain_seconds=10.0):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.drain_seconds = drain_seconds
+        self.in_flight = 0
+        self._queue = None
+        self._tasks = []
+        self._pending = set()
+
+    # Workers are bound to the running event loop, so they start on first use
+    # when the app runs without its lifespan (e.g. under httpx.ASGITransport)
+    async def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_size)
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    # Give queued jobs drain_seconds to finish, then cancel the rest
+    async def stop(self):
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), self.drain_seconds)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with %d jobs still queued", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        self._queue = None
+        self._tasks = []
+        self._pending.clear()
+
+    # Waits for room when the queue is full, so a burst slows producers down
+    # instead of growing memory without bound
+    async def enqueue(self, name, *args):
+        if name not in jobs:
+            raise KeyError(f"Unknown job: {name}")
+        await self.start()
+        key = json.dumps([name, args], default=str)
+        if key in self._pending:
+            metrics.observe_task(name, "deduplicated")
+            return False
+        self._pending.add(key)
+        metrics.observe_task(name, "enqueued")
+        await self._queue.put((key, name, args))
+        return True
+
+    async def _work(self):
+        # Workers start inside whichever request enqueued first; don't charge
+        # their Mongo commands to it
+        current_request.set(None)
+        while True:
+            key, name, args = await self._queue.get()
+            # A change made from here on must run the job again
+            self._pending.discard(key)
+            self.in_flight += 1
+            try:
+                await run_job(name, args, self.max_attempts, self.retry_backoff)
+            finally:
+                self.in_flight -= 1
+                self._queue.task_done()
+
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def metric_lines(self):
+        labels = f'{{backend="{self.backend}"}}'
+        return [
+            "# HELP task_queue_depth Jobs waiting to run",
+            "# TYPE task_queue_depth gauge",
+            f"task_queue_depth{labels} {self.depth()}",
+            "# HELP task_queue_in_flight Jobs running now",
+            "# TYPE task_queue_in_flight gauge",
+            f"task_queue_in_flight{labels} {self.in_flight}",
+            "# TYPE task_queue_workers gauge",
+            f"task_queue_workers{labels} {self.workers}",
+        ]
+
+
+class InlineQueue(LocalQueue):
+    backend = "inline"
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def enqueue(self, name, *args):
+        if name not in jobs:
+            raise KeyError(f"Unknown job: {name}")
+        metrics.observe_task(name, "enqueued")
+        self.in_flight += 1
+        try:
+            return await run_job(name, args, self.max_attempts, self.retry_backoff)
+        finally:
+            self.in_flight -= 1
+
+
+# TASK_BACKEND=local (default) | inline
+def make_queue():
+    queue_class = InlineQueue if os.getenv("TASK_BACKEND", "local") == "inline" else LocalQueue
+    return queue_class(
+        workers=int(os.getenv("TASK_WORKERS", "4")),
+        max_size=int(os.getenv("TASK_QUEUE_SIZE", "10000")),
+        max_attempts=int(os.getenv("TASK_MAX_ATTEMPTS", "3")),
+        retry_backoff=float(os.getenv("TASK_RETRY_BACKOFF_SECONDS", "0.5")),
+        drain_seconds=float(os.getenv("TASK_DRAIN_SECONDS", "10")),
+    )